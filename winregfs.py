@@ -4,12 +4,25 @@
 Basic command-line usage:
     ./winregfs.py <hivefile> <mountpoint>
     unmount with fusermount -u <mountpoint>
+    ./winregfs.py --build-index <hivefile> to index it for faster mounting
+    ./winregfs.py --export <out.tar> <hivefile> [<path>] to dump it without mounting
+    ./winregfs.py --batch <list> --export <outdir> [-j N] to dump many in parallel
+    ./winregfs.py --images <list> <mountpoint> to mount many in one process
     ./winregfs.py --help for more detailed information.
 
 Quick overview of classes:
-    WinRegFS      Mounts the filesystem and accesses the registry
-    RegistryTree  All registry access functionality
-    MountOptions  Parses special command-line options
+    WinRegFS          Mounts the filesystem and accesses the registry
+    RegistryTree      All registry access functionality
+    RegistryForest    Several registries in one RegistryTree, sharing what they can
+    Node              What RegistryTree.resolve() says is at a path
+    LRUCache          Size-bounded cache used by RegistryTree
+    FileHandles       Open files and their rendered data, for WinRegFS
+    Prefetcher        Background cache warm-up, for WinRegFS
+    OpStats           Operation counts and timings, for WinRegFS
+    Tracer            Trace file of every operation, for WinRegFS
+    RegistrySnapshot  A whole RegistryTree held as columns of arrays
+    RegistryIndex     Prebuilt lookup table for a RegistryTree, kept on disk
+    MountOptions      Parses special command-line options
 
 See WinRegFS for the top-level filesystem methods.
 
@@ -21,7 +34,22 @@ import errno
 import subprocess
 import time
 import stat
+import struct
+import mmap
+import bisect
+import threading
+import hashlib
+import array
+import resource
+import json
+import re
+import base64
+import tarfile
+import shutil
+import tempfile
+import multiprocessing
 import argparse
+from collections import OrderedDict, deque
 
 # The registry and FUSE modules.
 # Prepending these to the module search path is ugly, but I'm not sure how
@@ -63,12 +91,1004 @@ except ImportError as ex:
         raise(ex)
 
 
-class RegistryTree():
+class LRUCache(object):
+    """A size-bounded mapping that forgets the least recently used entries.
+
+    Lookups through get() are counted in the hits and misses attributes, so
+    it's easy to see how well a cache is doing.  Setting size to 0 disables
+    the cache entirely.
+
+    It's safe to use from several threads at once.  Entries themselves
+    aren't copied or locked, so they should be things that don't change
+    once they're put in.
+
+    """
+    def __init__(self, size=1024):
+        self.size = size  # Maximum number of entries to hold
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the entry for key (or default), counting a hit or miss."""
+        value = self.peek(key, default)
+        self.count(value is not default)
+        return value
+
+    def count(self, hit):
+        """Count a hit (or a miss) for a lookup that was done some other way."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def peek(self, key, default=None):
+        """Return the entry for key (or default) without counting anything."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value # move it back to the most-recent end
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            if self.size <= 0:
+                return
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# errno for "no such extended attribute"; Linux only has the ENODATA name.
+ENOATTR = getattr(errno, "ENOATTR", errno.ENODATA)
+
+
+def _yes(setting):
+    """Turn a "yes"/"no" option from the command line into a bool."""
+    if setting in ("yes", "no"):
+        return setting == "yes"
+    return bool(setting)
+
+
+def _size(setting):
+    """Turn a size like "256M" (or "1G", "64K", "4096") into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    setting = setting.strip().upper()
+    if setting[-1:] in units:
+        return int(setting[:-1]) * units[setting[-1]]
+    return int(setting)
+
+
+# The best clock there is for timing things
+_clock = getattr(time, "perf_counter", time.time)
+
+
+def _private_memory():
+    """Return how much memory this process has of its own, in bytes.
+
+    That's what's resident now, less pages shared with files, so a mapped
+    hivefile being paged in doesn't count.  Without /proc (OS X, say), it's
+    the peak resident size instead, which does.
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * resource.getpagesize()
+    except (EnvironmentError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux gives this in KiB, OS X in bytes.
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _lh_hash(name):
+    """Return the hash an lh subkey list stores for a (plain ASCII) key name."""
+    h = 0
+    for c in name.upper():
+        h = (h * 37 + ord(c)) & 0xFFFFFFFF
+    return h
+
+
+def _subkey_list_entries(buf, offset, start=0):
+    """Yield (list type, NK record offset, hash) for a subkey list cell.
+
+    offset is the absolute offset of the list's cell in buf.  ri lists are
+    followed down to the lists they point to.  The hash is the raw dword
+    stored next to each entry in lf and lh lists, or None for li lists.
+    The first start entries are skipped without reading them.
+
+    """
+    # Offsets inside a hive are relative to the first hbin, at 0x1000, and
+    # point at a cell; the record itself starts after the cell's size field.
+    record = offset + 4
+    kind = buf[record:record + 2]
+    count = struct.unpack_from("<H", buf, record + 2)[0]
+    if kind in (b"lf", b"lh"):
+        for i in range(start, count):
+            cell, hint = struct.unpack_from("<II", buf, record + 4 + 8 * i)
+            yield kind, 0x1000 + cell + 4, hint
+    elif kind == b"li":
+        for i in range(start, count):
+            cell = struct.unpack_from("<I", buf, record + 4 + 4 * i)[0]
+            yield kind, 0x1000 + cell + 4, None
+    elif kind == b"ri":
+        for i in range(count):
+            sublist = 0x1000 + struct.unpack_from("<I", buf, record + 4 + 4 * i)[0]
+            # Skip whole lists by their counts when possible.
+            subcount = struct.unpack_from("<H", buf, sublist + 6)[0]
+            if start >= subcount and buf[sublist + 4:sublist + 6] != b"ri":
+                start -= subcount
+                continue
+            for entry in _subkey_list_entries(buf, sublist, start):
+                yield entry
+            start = 0
+    else:
+        raise RegistryParse.ParseException("unsupported subkey list type")
+
+
+def _value_list_entries(buf, nk, start=0):
+    """Yield the VK record offset of each value of an NKRecord, from start on."""
+    count = nk.values_number()
+    if start >= count:
+        return
+    # The values list is just an array of cell offsets.
+    record = nk.abs_offset_from_hbin_offset(nk.unpack_dword(0x28)) + 4
+    for i in range(start, count):
+        cell = struct.unpack_from("<I", buf, record + 4 * i)[0]
+        yield 0x1000 + cell + 4
+
+
+def _binary_data_pieces(vk):
+    """Return where the raw data of a RegBin or RegNone VKRecord is in its hive.
+
+    The result is a list of (offset in the hive's buffer, length) pieces,
+    which joined together are vk.raw_data().  This follows the same cases as
+    VKRecord.raw_data() in python-registry, but only reads the lengths and
+    cell sizes along the way, not the data.
+
+    """
+    buf = vk._buf
+    length = vk.raw_data_length()
+    offset = vk.data_offset()
+    piece = lambda start, n: (start, max(0, min(n, len(buf) - start)))
+    cellsize = lambda cell: abs(struct.unpack_from("<i", buf, cell)[0])
+    # Inline, in the data offset field itself
+    if length >= 0x80000000:
+        return [piece(offset, length - 0x80000000)]
+    # One cell
+    if length <= 0x3fd8:
+        return [piece(offset + 4, length)]
+    # Big data should be a db record, pointing at a list of cells that each
+    # hold up to 0x3fd8 bytes of it.
+    if buf[offset + 4:offset + 6] != b"db":
+        return [piece(offset + 4, min(length, cellsize(offset)))]
+    seglist = 0x1000 + struct.unpack_from("<I", buf, offset + 8)[0] + 4
+    pieces = []
+    for i in range((length + 0x3fd7) // 0x3fd8):
+        cell = 0x1000 + struct.unpack_from("<I", buf, seglist + 4 * i)[0]
+        chunk = min(0x3fd8, length - 0x3fd8 * i)
+        pieces.append(piece(cell + 4, min(chunk, cellsize(cell))))
+    return pieces
+
+
+def _binary_data_size(vk):
+    """Return len(vk.raw_data()) for a RegBin or RegNone VKRecord."""
+    return sum(length for start, length in _binary_data_pieces(vk))
+
+
+class Node(object):
+    """A compact description of whatever is at a filesystem path.
+
+    kind is one of DIR (a directory with no registry key behind it, like / or
+    /HKLM), KEY or VALUE.  For keys and values, hive is the index of the
+    registry file they're in and offset is the position of their NK or VK
+    record in that file; RegistryTree can turn those back into key and value
+    objects.  mtime, size and nlink are the values to report in stat().
+
+    inode is derived from the hive index and record offset, so it stays the
+    same across mounts of the same files.  DIR nodes are given small inode
+    numbers (below 2**32) by RegistryTree instead.
+
+    """
+    __slots__ = ("kind", "hive", "offset", "mtime", "size", "inode", "nlink")
+
+    DIR   = "dir"
+    KEY   = "key"
+    VALUE = "value"
+
+    def __init__(self, kind, hive=None, offset=None, mtime=0, size=0, inode=None):
+        self.kind = kind
+        self.hive = hive
+        self.offset = offset
+        self.mtime = mtime
+        self.size = size
+        if inode is None and offset is not None:
+            inode = Node.inode_for(hive, offset)
+        self.inode = inode
+        self.nlink = 1 if kind == Node.VALUE else 2
+
+    def __repr__(self):
+        return "Node(%r, %r, %r, %r, %r, %r)" % (self.kind, self.hive,
+                self.offset, self.mtime, self.size, self.inode)
+
+    @staticmethod
+    def inode_for(hive, offset):
+        """Return the inode number for a record offset in the given hive."""
+        return ((hive + 1) << 32) | offset
+
+    @staticmethod
+    def split_inode(inode):
+        """Return the (hive, offset) an inode number was made from."""
+        return (inode >> 32) - 1, inode & 0xFFFFFFFF
+
+
+class FileHandles(object):
+    """Open files, each with its value's data rendered once for all reads.
+
+    A value is rendered the first time its handle is read from and then kept
+    as a memoryview, so each read just slices out the part it wants.  The
+    total size of all rendered data is kept under budget bytes by dropping
+    the least recently read buffers (a handle that lost its buffer just
+    renders it again next time.)  A single buffer bigger than the whole
+    budget is still kept while it's the one being read.
+
+    Handles can be used from several threads at once.  Rendering happens
+    outside the lock, so one slow value doesn't hold up reads of others.
+
+    """
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget  # Bytes of rendered data to keep, in total
+        self.used = 0
+        self._next = 1
+        self._nodes = {}  # handle -> Node
+        self._buffers = OrderedDict() # handle -> memoryview, least recent first
+        self._lock = threading.Lock()
+
+    def open(self, node):
+        """Return a new handle for the given Node."""
+        with self._lock:
+            fh = self._next
+            self._next += 1
+            self._nodes[fh] = node
+        return fh
+
+    def node(self, fh):
+        """Return the Node for a handle.  Raises KeyError for unknown handles."""
+        return self._nodes[fh]
+
+    def buffer(self, fh, render):
+        """Return the data for a handle, calling render(node) if it's not kept."""
+        with self._lock:
+            data = self._buffers.pop(fh, None)
+            if data is not None:
+                self._buffers[fh] = data
+                return data
+            node = self._nodes[fh]
+        data = memoryview(render(node))
+        with self._lock:
+            # Another thread may have rendered it in the meantime, or the
+            # handle may be gone.  Either way, only count it once.
+            if fh in self._nodes and fh not in self._buffers:
+                self._buffers[fh] = data
+                self.used += len(data)
+                while len(self._buffers) > 1 and self.used > self.budget:
+                    self.used -= len(self._buffers.popitem(last=False)[1])
+        return data
+
+    def release(self, fh):
+        """Forget a handle and its data."""
+        with self._lock:
+            self._nodes.pop(fh, None)
+            data = self._buffers.pop(fh, None)
+            if data is not None:
+                self.used -= len(data)
+
+    def clear(self):
+        """Forget every handle and its data.  Handle numbers aren't reused."""
+        with self._lock:
+            self._nodes.clear()
+            self._buffers.clear()
+            self.used = 0
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class Prefetcher(object):
+    """Warms up a RegistryTree in the background, for WinRegFS.
+
+    A thread walks the tree breadth-first (see RegistryTree.walk()), which
+    looks up every key and value along the way, filling in the tree's
+    caches and paging in the hivefiles before anyone asks for them.  It
+    stops after depth levels, once it's walked as many paths (or keys) as
+    the tree's caches hold, once the process's own memory (see
+    _private_memory(); mapped hivefiles aren't counted) has grown by budget
+    bytes since it started, or when there's nothing left.  If a lookup
+    fails, it stops there, and says why in error and on stderr.
+
+    It only works while nothing else is: WinRegFS calls begin() and end()
+    around every filesystem operation, and the walk waits between steps
+    until no operations are in progress.
+
+    """
+    def __init__(self, depth=None, budget=256 * 1024 * 1024):
+        self.depth = depth # Levels below / to go (None: all of them)
+        self.budget = budget # Bytes the process can grow by (None: no limit)
+        self.visited = 0 # Paths walked so far
+        self.error = None # Why the walk stopped early, if it failed
+        self._busy = 0 # Filesystem operations in progress
+        self._idle = threading.Condition(threading.Lock())
+        self._stopped = False
+        self._thread = None
+        self._yielded = 0 # When the walk last gave up the interpreter lock
+
+    # Seconds of walking between giving other threads a turn
+    YIELD_INTERVAL = 0.001
+    # Paths walked between checks on the memory budget
+    MEMORY_INTERVAL = 256
+
+    def start(self, tree):
+        """Start walking the given tree in a background thread."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, args=(tree,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """Wait for the walk to finish."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self):
+        """Stop walking, and wait for the thread to notice."""
+        with self._idle:
+            self._stopped = True
+            self._idle.notify_all()
+        self.join()
+
+    def begin(self):
+        """Note that a filesystem operation has started."""
+        with self._idle:
+            self._busy += 1
+
+    def end(self):
+        """Note that a filesystem operation has finished."""
+        with self._idle:
+            self._busy -= 1
+            if not self._busy:
+                self._idle.notify_all()
+
+    def _wait(self):
+        """Wait until no operations are running.  False if stopped instead."""
+        # Every so often, let go of the interpreter lock for a moment, so a
+        # thread that wants it to start an operation doesn't have to wait
+        # for us to use up our whole turn.
+        now = _clock()
+        if now - self._yielded > self.YIELD_INTERVAL:
+            time.sleep(0)
+            self._yielded = now
+        with self._idle:
+            while self._busy and not self._stopped:
+                self._idle.wait()
+            return not self._stopped
+
+    def _run(self, tree):
+        start = _private_memory()
+        path = "/"
+        # The caches only count entries, so past their size the walk would
+        # just push out the shallow paths it already put in, which are the
+        # likeliest to be wanted.
+        keys = 0
+        try:
+            for path, node in tree.walk("/", self.depth):
+                self.visited += 1
+                if node.kind != Node.VALUE:
+                    keys += 1
+                if self.visited >= tree.paths.size or keys >= tree.key_cache.size:
+                    break
+                if not self._wait():
+                    break
+                if (self.budget is not None and not self.visited % self.MEMORY_INTERVAL
+                        and _private_memory() - start > self.budget):
+                    break
+        except Exception as e:
+            # The same lookup in the foreground will run into it too and
+            # report it properly, but say why the warm-up stopped short.
+            self.error = str(e) or type(e).__name__
+            sys.stderr.write("Error: prefetching stopped after " + path + ": " +
+                    self.error + "\n")
+
+
+class OpStats(object):
+    """Counts and timings of filesystem operations, for WinRegFS.
+
+    For each operation there's a count of calls and errors, the total time
+    taken, bytes handed back (for reads), and a histogram of how long calls
+    took, in power-of-two buckets of microseconds.  WinRegFS also times
+    the parts of operations that go to its tree, as "tree.resolve" (looking
+    up paths) and "tree.render" (converting values' data).  summary() puts
+    that together with the tree's cache hit counts.
+
+    """
+    BUCKETS = 32 # The last one takes everything over 2**30 us
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, tree=None):
+        """Start counting from zero again.
+
+        The tree's caches keep their own counts, so those are remembered
+        here and taken off again in summary().
+
+        """
+        with self._lock:
+            self.since = time.time()
+            self.ops = {} # name -> [calls, errors, seconds, bytes, histogram]
+            self._tree = tree
+            self._cache_counts = {}
+            if tree is not None:
+                for name in tree.CACHES:
+                    cache = getattr(tree, name)
+                    self._cache_counts[name] = (cache.hits, cache.misses)
+
+    def add(self, op, seconds, nbytes=0, error=False):
+        """Count one call of op that took the given time."""
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        with self._lock:
+            entry = self.ops.get(op)
+            if entry is None:
+                entry = self.ops[op] = [0, 0, 0.0, 0, [0] * self.BUCKETS]
+            entry[0] += 1
+            if error:
+                entry[1] += 1
+            entry[2] += seconds
+            entry[3] += nbytes
+            entry[4][bucket] += 1
+
+    def summary(self, tree=None):
+        """Return everything counted so far as a dict, ready for JSON.
+
+        Percentiles are the upper ends of the histogram buckets they fall
+        in, so they're only accurate to within a factor of two.
+
+        """
+        with self._lock:
+            ops = dict((op, list(entry[:4]) + [list(entry[4])])
+                    for op, entry in self.ops.items())
+            since = self.since
+            counts = self._cache_counts if tree is self._tree else {}
+        summary = {"since": since, "seconds": time.time() - since, "ops": {}}
+        for op, (calls, errors, seconds, nbytes, histogram) in ops.items():
+            def percentile(p):
+                seen = 0
+                for bucket, n in enumerate(histogram):
+                    seen += n
+                    if seen >= calls * p:
+                        return 2 ** bucket
+            summary["ops"][op] = {"calls": calls, "errors": errors,
+                    "total_ms": seconds * 1e3, "mean_us": seconds * 1e6 / calls,
+                    "p50_us": percentile(0.5), "p90_us": percentile(0.9),
+                    "p99_us": percentile(0.99), "bytes": nbytes,
+                    "histogram_us": dict(("<" + str(2 ** bucket), n)
+                        for bucket, n in enumerate(histogram) if n)}
+        if tree is not None:
+            summary["caches"] = {}
+            for name in tree.CACHES:
+                cache = getattr(tree, name)
+                hits, misses = counts.get(name, (0, 0))
+                hits, misses = cache.hits - hits, cache.misses - misses
+                summary["caches"][name] = {"hits": hits, "misses": misses,
+                        "hit_ratio": float(hits) / (hits + misses) if hits + misses else None,
+                        "entries": len(cache), "size": cache.size}
+        return summary
+
+
+class Tracer(object):
+    """Writes a line to a trace file for every filesystem operation, for WinRegFS.
+
+    Each line has these tab-separated fields:
+
+        time    when the operation started, in seconds since the trace did
+        us      how long it took, in microseconds
+        op      operation name
+        path
+        size    bytes asked for (read), or entries taken (readdir)
+        offset  for read and readdir
+        fh      file handle, for open (the new one), read and release
+        name    attribute name, for getxattr
+        error   errno, if it failed (otherwise 0)
+
+    Tabs, newlines and backslashes in paths and names are escaped with
+    backslashes.  The first line is a comment with the absolute start time.
+    winregfs_bench.py --replay plays a trace back against a hivefile.
+
+    Nothing's written until start(), which WinRegFS calls from init(), once
+    mount() has forked into the background.  (A header written before that
+    would still be sitting in the file's buffer in both processes.)
+
+    """
+    FIELDS = ("time", "us", "op", "path", "size", "offset", "fh", "name", "error")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._lock = threading.Lock()
+        self.started = _clock()
+        # Find out now if it can't be written, rather than once mounted.
+        open(filename, "w").close()
+
+    def start(self):
+        """Start writing the trace, beginning with the header line."""
+        with self._lock:
+            self._file = open(self.filename, "w")
+            self.started = _clock()
+            self._file.write("# winregfs trace started %.6f\t%s\n" %
+                    (time.time(), "\t".join(self.FIELDS)))
+
+    @staticmethod
+    def escape(text):
+        """Escape a path or name for a trace line."""
+        return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+    @staticmethod
+    def unescape(text):
+        """Undo escape()."""
+        return re.sub(r"\\(.)", lambda m: {"t": "\t", "n": "\n"}.get(m.group(1), m.group(1)), text)
+
+    def record(self, op, args, start, seconds, error=0, count=0):
+        """Write a line for one call of op(*args)."""
+        path = args[0] if args else ""
+        size = offset = 0
+        fh = None
+        name = ""
+        if op == "read":
+            size, offset, fh = args[1:4]
+        elif op == "readdir":
+            fh = args[1]
+            offset = args[2] if len(args) > 2 else 0
+            size = count
+        elif op in ("open", "release", "getattr"):
+            fh = args[1] if len(args) > 1 else None
+        elif op == "getxattr":
+            name = args[1]
+        fh = getattr(fh, "fh", fh) or 0
+        line = "%.6f\t%d\t%s\t%s\t%d\t%d\t%d\t%s\t%d\n" % (
+                start - self.started, seconds * 1e6, op, self.escape(path),
+                size, offset, fh, self.escape(name), error)
+        with self._lock:
+            if self._file is not None and not self._file.closed:
+                self._file.write(line)
+
+    def close(self):
+        """Finish writing the trace."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+
+
+class _MappedFile(object):
+    """Hands a mapped file to Registry(), which only wants something to read().
+
+    A mmap object has its own read(), but that would copy the data out.
+
+    """
+    def __init__(self, buf):
+        self.buf = buf
+
+    def read(self):
+        return self.buf
+
+
+# What a tar archive ends with: two empty blocks
+_TAR_END = b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+class _NodeFile(object):
+    """Reads a VALUE Node's data bit by bit, for tarfile.
+
+    Values that node_read() can handle are copied out of the hive a piece at
+    a time, so even a huge one never has to be in memory all at once.
+    Anything else is rendered with node_data() in one go, on the first read.
+
+    """
+    def __init__(self, tree, node):
+        self.tree = tree
+        self.node = node
+        self.offset = 0
+        self.data = None
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.node.size - self.offset
+        if self.data is None:
+            data = self.tree.node_read(self.node, self.offset, size)
+            if data is not None:
+                self.offset += len(data)
+                return data
+            self.data = self.tree.node_data(self.node)
+        data = self.data[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+class RegistrySnapshot(object):
+    """A whole RegistryTree's worth of Nodes, kept as columns of arrays.
+
+    RegistryTree.take_snapshot() walks a tree once to make one of these, and
+    from then on resolve(), items() and stat() are answered from it.  Each
+    path gets a row, in breadth-first order from / (row 0), so that a
+    directory's children are all together.  The columns are plain arrays,
+    so a job that goes over everything can read them directly instead of
+    making an object for every key and value:
+
+        parent          row of the directory it's in
+        kind            index into KINDS (Node.DIR, Node.KEY, Node.VALUE)
+        hive, offset    as in Node, but hive is -1 for DIR rows, and offset is
+                        the inode number for those
+        value_type      registry data type, for values (0 otherwise)
+        data_offset     a value's data offset and length fields, straight from
+        data_length     its VK record (the offset counts from the first hbin,
+                        and a length with the top bit set means the data's
+                        in the offset field itself)
+        size, mtime, nlink
+                        as in Node
+        first_child     row of the first thing in a directory, and how many
+        child_count     there are
+
+    Row i's name is names[name_start[i]:name_start[i + 1]], and lookup holds
+    each directory's children again, but sorted by lowercased name with keys
+    first, for bisecting.  All told that's about 60 bytes a row plus names.
+
+    """
+    KINDS = (Node.DIR, Node.KEY, Node.VALUE)
+
+    def __init__(self, tree):
+        self.parent = array.array("I")
+        self.name_start = array.array("I", [0])
+        self.kind = array.array("B")
+        self.hive = array.array("h")
+        self.offset = array.array("I")
+        self.value_type = array.array("I")
+        self.data_offset = array.array("I")
+        self.data_length = array.array("I")
+        self.size = array.array("I")
+        self.mtime = array.array("d")
+        self.nlink = array.array("I")
+        self.first_child = array.array("I")
+        self.child_count = array.array("I")
+        names = []
+        dirs = {} # path -> row, for directories
+        length = 0
+        for path, node in tree.walk("/"):
+            row = len(self.parent)
+            name = u""
+            parent = 0
+            if row:
+                parentpath, name = path.rsplit('/', 1)
+                parent = dirs[parentpath or '/']
+                if not self.child_count[parent]:
+                    self.first_child[parent] = row
+                self.child_count[parent] += 1
+            if node.kind != Node.VALUE:
+                dirs[path] = row
+            names.append(name)
+            length += len(name)
+            self.parent.append(parent)
+            self.name_start.append(length)
+            self.kind.append(self.KINDS.index(node.kind))
+            if node.kind == Node.DIR:
+                self.hive.append(-1)
+                self.offset.append(node.inode)
+            else:
+                self.hive.append(node.hive)
+                self.offset.append(node.offset)
+            if node.kind == Node.VALUE:
+                vk = tree.record(node)._vkrecord
+                self.value_type.append(vk.data_type())
+                self.data_offset.append(vk.unpack_dword(0x8))
+                self.data_length.append(vk.raw_data_length())
+            else:
+                self.value_type.append(0)
+                self.data_offset.append(0)
+                self.data_length.append(0)
+            self.size.append(node.size)
+            self.mtime.append(node.mtime)
+            self.nlink.append(node.nlink)
+            self.first_child.append(0)
+            self.child_count.append(0)
+        self.names = u"".join(names)
+        # Each directory's children, sorted by name, with keys before values
+        self.lookup = array.array("I", range(len(self.parent)))
+        for first, count in zip(self.first_child, self.child_count):
+            if count:
+                self.lookup[first:first + count] = array.array("I", sorted(
+                        range(first, first + count),
+                        key=lambda i: (names[i].lower(), self.kind[i])))
+
+    def __len__(self):
+        return len(self.parent)
+
+    def name(self, row):
+        """Return the name of a row."""
+        return self.names[self.name_start[row]:self.name_start[row + 1]]
+
+    def path(self, row):
+        """Return the full path of a row."""
+        parts = []
+        while row:
+            parts.append(self.name(row))
+            row = self.parent[row]
+        return "/" + "/".join(reversed(parts))
+
+    def node(self, row):
+        """Return a Node for a row."""
+        kind = self.KINDS[self.kind[row]]
+        if kind == Node.DIR:
+            node = Node(kind, mtime=self.mtime[row], size=self.size[row],
+                    inode=self.offset[row])
+        else:
+            node = Node(kind, self.hive[row], self.offset[row],
+                    self.mtime[row], self.size[row])
+        node.nlink = self.nlink[row]
+        return node
+
+    def find(self, path):
+        """Return the row for a path.  Raises ValueError if it isn't there."""
+        row = 0
+        for part in [p for p in path.split('/') if p]:
+            row = self._child(row, part)
+            if row is None:
+                raise ValueError("specified item does not exist.")
+        return row
+
+    def _child(self, row, name):
+        """Return the row of the named child of a row, or None."""
+        first = self.first_child[row]
+        count = self.child_count[row]
+        target = name.lower()
+        # Bisect for the first child with that name; keys sort before
+        # values, so a key wins if there's both.
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(self.lookup[mid]).lower() < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < first + count and self.name(self.lookup[lo]).lower() == target:
+            return self.lookup[lo]
+        return None
+
+    def resolve(self, path):
+        """Return the Node for a path.  Raises ValueError if it isn't there."""
+        return self.node(self.find(path))
+
+    def children(self, path, start=0):
+        """Return an iterator of (name, Node) under a path, as for RegistryTree.children()."""
+        row = self.find(path)
+        if self.KINDS[self.kind[row]] == Node.VALUE:
+            raise ValueError("specified key does not exist.")
+        first = self.first_child[row]
+        rows = range(first + start, first + self.child_count[row])
+        return ((self.name(i), self.node(i)) for i in rows)
+
+
+class RegistryIndex(object):
+    """A prebuilt table of everything in a RegistryTree, kept in a file.
+
+    RegistryTree.write_index() walks a whole tree and writes one of these,
+    and RegistryTree.use_index() maps one back into memory on a later load.
+    resolve() and items() then come straight from the table, without
+    reading any NK or VK records.  (Values' data still comes from the
+    hives, of course.)
+
+    The file starts with a header, and the SHA-1 and size of each hive
+    file's base block (its first 4096 bytes) to tie it to the hives it was
+    built from.  Then there's a RECORD for each path, in breadth-first
+    order so each directory's children are all together, and a lookup
+    table giving each directory's children again, but sorted by lowercased
+    name so a name can be found by bisecting.  Last are all the names, as
+    UTF-8.
+
+    """
+    MAGIC = b"WRFSIDX1"
+    VERSION = 1
+    # magic, version, flags, number of hives, number of records, and the
+    # file offsets of the records, lookup table and names
+    HEADER = struct.Struct("<8sIIIIQQQ")
+    # SHA-1 of the hive's base block, hive file size
+    HIVE = struct.Struct("<20sQ")
+    # parent, name offset and length, kind, hive, record offset, inode,
+    # size, mtime, nlink, first child, number of children
+    RECORD = struct.Struct("<IIIB3xiIQQdIII")
+    KINDS = RegistrySnapshot.KINDS
+    # Flags for the RegistryTree settings that change names and sizes
+    EXTENSIONS = 1
+    NEWLINE = 2
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            try:
+                self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('"' + filename + '" is empty.')
+        if len(self._buf) < self.HEADER.size:
+            raise ValueError('"' + filename + '" is not a winregfs index.')
+        (magic, version, self.flags, hives, self.count, self._records,
+                self._lookup, self._names) = self.HEADER.unpack_from(self._buf, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('"' + filename + '" is not a winregfs index.')
+        self.hives = [self.HIVE.unpack_from(self._buf, self.HEADER.size + i * self.HIVE.size)
+                for i in range(hives)]
+
+    @staticmethod
+    def default_path(registry):
+        """Return where the index for a hivefile or directory goes by default."""
+        return os.path.abspath(registry).rstrip(os.sep) + ".winregfs-index"
+
+    @staticmethod
+    def hive_stamp(path):
+        """Return the (SHA-1 of the base block, size) for a hive file."""
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read(0x1000)).digest()
+            f.seek(0, os.SEEK_END)
+            return digest, f.tell()
+
+    @classmethod
+    def tree_flags(cls, tree):
+        """Return the flags an index for the given tree should have."""
+        return ((cls.EXTENSIONS if tree.append_extensions else 0) |
+                (cls.NEWLINE if tree.append_newline else 0))
+
+    def matches(self, tree):
+        """True if this index was built from the hive files the tree has, as they are now."""
+        if self.flags != self.tree_flags(tree):
+            return False
+        if len(self.hives) != len(tree._hive_files):
+            return False
+        for stamp, path in zip(self.hives, tree._hive_files):
+            if tuple(stamp) != self.hive_stamp(path):
+                return False
+        return True
+
+    # Reading
+
+    def _record(self, i):
+        return self.RECORD.unpack_from(self._buf, self._records + i * self.RECORD.size)
+
+    def _name(self, record):
+        start = self._names + record[1]
+        return self._buf[start:start + record[2]].decode("utf-8")
+
+    def _node(self, record):
+        """Return a Node for a record."""
+        kind = self.KINDS[record[3]]
+        if kind == Node.DIR:
+            node = Node(kind, mtime=record[8], size=record[7], inode=record[6])
+        else:
+            node = Node(kind, record[4], record[5], record[8], record[7], record[6])
+        node.nlink = record[9]
+        return node
+
+    def _child(self, record, name):
+        """Return the index of the named child of a record, or None."""
+        first, count = record[10], record[11]
+        target = name.lower()
+        lookup = lambda j: struct.unpack_from("<I", self._buf, self._lookup + 4 * j)[0]
+        # Bisect for the first child with that name; keys sort before
+        # values, so a key wins if there's both.
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(self._record(lookup(mid))).lower() < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < first + count:
+            i = lookup(lo)
+            if self._name(self._record(i)).lower() == target:
+                return i
+        return None
+
+    def _find(self, path):
+        """Return the record for a path.  Raises ValueError if it isn't there."""
+        record = self._record(0)
+        for part in [p for p in path.split('/') if p]:
+            i = self._child(record, part)
+            if i is None:
+                raise ValueError("specified item does not exist.")
+            record = self._record(i)
+        return record
+
+    def resolve(self, path):
+        """Return the Node for a path.  Raises ValueError if it isn't there."""
+        return self._node(self._find(path))
+
+    def children(self, path, start=0):
+        """Return an iterator of (name, Node) under a path, as for RegistryTree.children()."""
+        record = self._find(path)
+        if self.KINDS[record[3]] == Node.VALUE:
+            raise ValueError("specified key does not exist.")
+        return self._iter_children(record, start)
+
+    def _iter_children(self, record, start):
+        first, count = record[10], record[11]
+        for i in range(first + start, first + count):
+            child = self._record(i)
+            yield self._name(child), self._node(child)
+
+    # Writing
+
+    @classmethod
+    def write(cls, tree, filename):
+        """Walk the whole of a loaded tree and write its index to filename.
+
+        Returns the number of paths in the index.
+
+        """
+        snapshot = RegistrySnapshot(tree)
+        count = len(snapshot)
+        hives = b"".join(cls.HIVE.pack(*cls.hive_stamp(path)) for path in tree._hive_files)
+        start = cls.HEADER.size + len(hives)
+        lookup_start = start + cls.RECORD.size * count
+        names_start = lookup_start + 4 * count
+        names = bytearray()
+        lookup = array.array("I", snapshot.lookup)
+        if sys.byteorder != "little":
+            lookup.byteswap()
+        with open(filename, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.tree_flags(tree),
+                    len(tree._hive_files), count, start, lookup_start,
+                    names_start))
+            f.write(hives)
+            for i in range(count):
+                name = snapshot.name(i)
+                namebytes = name if isinstance(name, bytes) else name.encode("utf-8")
+                node = snapshot.node(i)
+                f.write(cls.RECORD.pack(snapshot.parent[i], len(names),
+                        len(namebytes), snapshot.kind[i], snapshot.hive[i],
+                        node.offset or 0, node.inode, node.size, node.mtime,
+                        node.nlink, snapshot.first_child[i],
+                        snapshot.child_count[i]))
+                names += namebytes
+            f.write(lookup.tostring() if hasattr(lookup, "tostring") else lookup.tobytes())
+            f.write(names)
+        return count
+
+
+class RegistryTree(object):
     """Manages reading data from a single registry file.
     
     One of these is used by WinRegFS for all registry access.
     Paths given to methods here are always filesystem paths, but the objects
     returned are of type RegistryKey or RegistryValue.
+
+    Once loaded, a tree can be read from several threads at once.  The hive
+    buffers and python-registry's objects are only ever read, everything
+    that's cached is built in full before it's put in its (locked) cache,
+    and loading a hive on first use is the only other thing that's locked.
+    load() and reload() are not safe to call while other threads are using
+    the tree, though; see reloaded() for that.
     
     """
     # These data types will be considered text, as far as conversion to bytes
@@ -76,10 +1096,57 @@ class RegistryTree():
     TEXT_TYPES= [Registry.RegSZ, Registry.RegExpandSZ, Registry.RegMultiSZ,
             Registry.RegDWord, Registry.RegQWord]
 
+    # Keys with at least this many subkeys get a name -> subkey dict built
+    # the first time something is looked up in them.  Smaller keys are just
+    # scanned, using the name hashes in the subkey list to skip most entries.
+    SUBKEY_INDEX_MIN = 64
+
+    # The LRUCache attributes, all of which are emptied by load()
+    CACHES = ("key_cache", "value_names", "subkey_names", "inodes",
+            "value_sizes", "data_pieces", "missing", "paths")
+
     def __init__(self):
         self.append_extensions = True  # Append data type to each filename?
         self.append_newline = True  # Add a newline to each "file" (if text)?
-        self.__loaded = False
+        # Resolved keys, by hive and lowercased path.  Every lookup walks down
+        # from the deepest cached parent, so repeated lookups under the same
+        # key don't have to start from the root of the hive each time.
+        self.key_cache = LRUCache(4096)
+        # Filename -> value record offset, for each key we've looked for a
+        # value in.  Built the first time it's needed for a key, so after
+        # that finding a value is a dict lookup instead of a scan.
+        self.value_names = LRUCache(256)
+        # Lowercased name -> subkey record offset, for big keys.
+        self.subkey_names = LRUCache(256)
+        # Inode number -> Node, for the Nodes node() has rebuilt from inode
+        # numbers.  (Nothing else goes in here; resolve() has paths.)
+        self.inodes = LRUCache(4096)
+        # Sizes of rendered text values, by hive, VK record offset and
+        # append_newline.  (Other types' sizes are cheap to work out again.)
+        self.value_sizes = LRUCache(65536)
+        # Where binary values' data is in their hive, as (start of each
+        # piece in the data, pieces from _binary_data_pieces()), by hive and
+        # VK record offset.  See node_read().
+        self.data_pieces = LRUCache(256)
+        # Paths known not to exist, by append_extensions and path (see
+        # resolve()).  Shells and file managers look for the same missing
+        # names (.hidden, desktop.ini, ...) over and over.
+        self.missing = LRUCache(4096)
+        # Nodes resolve() has found, by append_extensions, append_newline
+        # and path, so looking up the same path again is one dict lookup.
+        self.paths = LRUCache(16384)
+        # Map hive files into memory instead of reading them in?  Pages then
+        # come from (and stay in) the OS's cache, shared with anything else
+        # that has the same file open, instead of each hive being copied into
+        # our own memory.
+        self.use_mmap = True
+        self.source = None # What load() was given
+        # RegistryIndex or RegistrySnapshot answering lookups, if any (see
+        # use_index() and take_snapshot())
+        self.index = None
+        self._load_lock = threading.Lock() # Held while loading a hive lazily
+        self._stamps = {} # file -> (mtime, size) when it was loaded
+        self._loaded = False
 
     def load(self, registry):
         """Load the given registry (either a single file or directory).
@@ -99,6 +1166,10 @@ class RegistryTree():
         # HKU\<SID>          %USERPROFILE%\NTUSER.DAT
         # HKU\<SID>_Classes  %USERPROFILE%\AppData\Local\Microsoft\Windows\UsrClass.dat
         # HKCC               (Generated dynamically at runtime)
+        self._loaded = False
+        self.source = registry
+        self.index = None
+        self._stamps = {}
         self.hives= {}
         self.hives["HKCR"] = {}
         self.hives["HKCU"] = {}
@@ -107,11 +1178,18 @@ class RegistryTree():
         self.hives["HKCC"] = {}
         self.configdir = None
         self.hivefile = None
+        self._regs = []  # (registry, first hbin) for each file, None until loaded
+        self._hive_files = [] # ... the file each one comes from
+        self._hive_index = {} # ... and the reverse: registry -> index
+        for name in self.CACHES:
+            getattr(self, name).clear()
         if os.path.isdir(registry):
             # With a directory, assume multiple-file usage and try loading
             # HKLM\system, either directly from that location or from
             # beneath Windows\System32\config.  If one of those works, also
-            # load whichever of the other HKLM files are present.
+            # load whichever of the other HKLM files are present.  ("Load"
+            # just means check for now; each file is only really read when
+            # something in it is first needed.)
             self.multifile = True
             testdir = os.path.join(registry, "Windows/System32/config")
             if os.path.isdir(testdir):
@@ -133,31 +1211,174 @@ class RegistryTree():
             # With just a file given, ignore all the hives stuff and just
             # give an interface to the specified file.
             self.multifile = False
-            self.hivefile = Registry.Registry(registry)
-        self.__loaded = True
+            self._stamp(registry)
+            self.hivefile = self._open_registry(registry)
+            self._hive_files.append(registry)
+            self._regs.append(None)
+            self._add_hive(self.hivefile, 0)
+        self._loaded = True
 
     def _load_regfile(self, hkey, regname, keyname=None, strictload=False):
-        """Load a single registry file into the tree."""
+        """Add a single registry file to the tree, to be loaded when needed.
+
+        Here the file is only checked to see that it exists and starts like a
+        hivefile.  The hive key's entry is the file's index in the tree (see
+        _hive()), or None if it isn't there.
+
+        """
         path = os.path.join(self.configdir, regname)
         keyname = keyname or regname
+        self._stamp(path)
         try:
-            hkey[keyname] = Registry.Registry(path)
-        except Exception as ex:
+            with open(path, "rb") as f:
+                magic = f.read(4)
+        except EnvironmentError:
+            magic = None
+        if magic != b"regf":
             if strictload:
-                raise ex
+                raise ValueError('"' + path + '" is not a registry hivefile.')
             hkey[keyname] = None
-    
+            return
+        hkey[keyname] = len(self._regs)
+        self._hive_files.append(path)
+        self._regs.append(None)
+
+    def _open_registry(self, path):
+        """Return a Registry for a file, mapped into memory if use_mmap is set."""
+        if self.use_mmap:
+            with open(path, "rb") as f:
+                try:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    buf = None # Empty, or can't be mapped.  Just read it.
+            if buf is not None:
+                return Registry.Registry(_MappedFile(buf))
+        return Registry.Registry(path)
+
+    def _stamp(self, path):
+        """Note a file's mtime and size (or None if missing) before loading it."""
+        try:
+            st = os.stat(path)
+            self._stamps[path] = (st.st_mtime, st.st_size)
+        except OSError:
+            self._stamps[path] = None
+
+    def changed(self):
+        """True if any file the tree was loaded from has changed since."""
+        for path in self._stamps:
+            stamp = self._stamps[path]
+            try:
+                st = os.stat(path)
+                if stamp != (st.st_mtime, st.st_size):
+                    return True
+            except OSError:
+                if stamp != None:
+                    return True
+        return False
+
+    def write_index(self, filename):
+        """Write an index of the whole tree to filename (see RegistryIndex).
+
+        Returns the number of paths in it.
+
+        """
+        return RegistryIndex.write(self, filename)
+
+    def use_index(self, filename):
+        """Answer lookups and listings from a RegistryIndex file from now on.
+
+        Raises ValueError if it wasn't built from the hive files loaded here,
+        or with different append_extensions and append_newline settings, so
+        set those first.
+
+        """
+        index = RegistryIndex(filename)
+        if not index.matches(self):
+            raise ValueError('"' + filename + '" is not an index for this registry.')
+        self.index = index
+
+    def take_snapshot(self):
+        """Read the whole tree into a RegistrySnapshot and answer lookups from it.
+
+        Returns the snapshot.  It's taken again after reload(), but as with
+        use_index(), set append_extensions and append_newline first.
+
+        """
+        self.index = RegistrySnapshot(self)
+        return self.index
+
+    def reloaded(self):
+        """Return a new tree with the same settings, loaded from the same source.
+
+        Unlike reload(), this leaves this tree alone, so other threads can
+        keep using it until they're handed the new one.
+
+        """
+        tree = RegistryTree()
+        tree.append_extensions = self.append_extensions
+        tree.append_newline = self.append_newline
+        tree.use_mmap = self.use_mmap
+        for name in self.CACHES:
+            getattr(tree, name).size = getattr(self, name).size
+        tree.load(self.source)
+        if isinstance(self.index, RegistrySnapshot):
+            tree.take_snapshot()
+        return tree
+
+    def reload(self):
+        """Load the same registry again, for when changed() says so."""
+        snapshot = isinstance(self.index, RegistrySnapshot)
+        try:
+            self.load(self.source)
+            if snapshot:
+                self.take_snapshot()
+        except Exception:
+            # Probably caught a file partway through being rewritten.  Make
+            # sure changed() keeps saying so, so the next check tries again.
+            self._stamps = {self.source: None}
+            raise
+
+    def _add_hive(self, reg, index):
+        """Put a loaded registry file at its index, for use in Nodes."""
+        hbin = next(reg._regf.hbins())
+        self._hive_index[reg] = index
+        self._regs[index] = (reg, hbin)
+
+    def _hive(self, index):
+        """Return (registry, first hbin) for a hive index, loading it if needed."""
+        if self._regs[index] is None:
+            with self._load_lock:
+                # Check again, in case another thread just loaded it.
+                if self._regs[index] is None:
+                    # A file that isn't a hive after all shows up as a
+                    # parse error, or struct.error if it's cut short.  Not
+                    # being able to read it at all (EACCES, EMFILE...) is
+                    # left as it is, so the real errno gets reported.
+                    try:
+                        reg = self._open_registry(self._hive_files[index])
+                        self._add_hive(reg, index)
+                    except (RegistryParse.RegistryException, struct.error, ValueError):
+                        raise ValueError('"' + self._hive_files[index] + '"' +
+                                " could not be loaded as a registry hivefile.")
+        return self._regs[index]
+
+    def _hive_reg(self, hkey, regkey):
+        """Return the registry for /hkey/regkey (multifile only)."""
+        try:
+            index = self.hives[hkey][regkey]
+        except KeyError:
+            raise ValueError("specified item does not exist.")
+        if index is None:
+            raise ValueError("specified item does not exist.")
+        return self._hive(index)[0]
+
     def key(self, path_to_key):
         """Return the given key object."""
         # Raises Registry.RegistryKeyNotFoundException if it isn't there
-        if not self.__loaded:
+        if not self._loaded:
             raise ValueError("load() must be called first.")
         reg, path_to_key = self._parse_reg(path_to_key)
-        try:
-            key = reg.open(self._path_to_regpath(path_to_key))
-        except RegistryParse.RegistryStructureDoesNotExist:
-            raise ValueError("specified key does not exist.")
-        return key
+        return self._open_key(reg, path_to_key)
 
     def value(self, path_to_value):
         """Return the given value object.
@@ -166,22 +1387,229 @@ class RegistryTree():
         a value read out of them as far as the registry itself is concerned.
         
         """
-        if not self.__loaded:
-            raise ValueError("load() must be called first")
-        reg, path_to_value = self._parse_reg(path_to_value)
+        node = self.resolve(path_to_value)
+        if node.kind != Node.VALUE:
+            raise ValueError("specified value does not exist")
+        return self.record(node)
+
+    def resolve(self, path):
+        """Return a Node for whatever is at the given path.
+
+        This does one lookup for the containing key and then checks its
+        subkeys and values for the last part of the path, so it's the cheap
+        way to find out what something is.  Raises ValueError if there's
+        nothing there.
+
+        Paths that turned out not to exist are remembered in missing, so
+        asking again (or asking for anything under one) doesn't touch the
+        hive at all.  missing.hits counts the lookups answered that way.
+        Paths that do exist are remembered in paths.
+
+        """
+        if not self._loaded:
+            raise ValueError("load() must be called first.")
+        parts = path.strip('/').split('/')
+        cachekey = self._path_key(path)
+        node = self.paths.get(cachekey)
+        if node is not None:
+            return node
+        for depth in range(len(parts), 0, -1):
+            if (self.append_extensions, '/'.join(parts[:depth])) in self.missing:
+                self.missing.count(True)
+                raise ValueError("specified item does not exist.")
+        self.missing.count(False)
         try:
-            reg.open(self._path_to_regpath(path_to_value))      # if this works...
-            raise ValueError("specified value does not exist")  # then wait a minute, it's a key
-        except RegistryParse.RegistryStructureDoesNotExist:
-            pass # OK, it's not a key, at least
-        key = self._path_to_regpath(os.path.dirname(path_to_value))       # get corresponding key from path
-        val = self._filename_to_regvalue(os.path.basename(path_to_value)) # trim off value name from path
+            node = self._resolve(path)
+        except ValueError:
+            self.missing[(self.append_extensions, '/'.join(parts))] = True
+            raise
+        self.paths[cachekey] = node
+        return node
+
+    def _path_key(self, path):
+        """Return what a path's Node is stored under in paths."""
+        return (self.append_extensions, self.append_newline, path.strip('/'))
+
+    def node(self, inode):
+        """Return the Node with the given inode number.
+
+        Keys and values are rebuilt from the inode number itself (and kept
+        in the inodes table for next time).  Raises ValueError for anything
+        else, including directories that have no key behind them.
+
+        """
+        node = self.inodes.get(inode)
+        if node is not None:
+            return node
+        hive, offset = Node.split_inode(inode)
+        if not 0 <= hive < len(self._regs):
+            raise ValueError("no such inode.")
+        reg = self._hive(hive)[0]
+        kind = reg._buf[offset:offset + 2]
+        if kind == b"nk":
+            node = self._key_node(reg, self._key_at(reg, offset))
+        elif kind == b"vk":
+            node = Node(Node.VALUE, hive, offset)
+            node.size = self._value_size(reg, self.record(node))
+        else:
+            raise ValueError("no such inode.")
+        self.inodes[inode] = node
+        return node
+
+    def _resolve(self, path):
+        if not self._loaded:
+            raise ValueError("load() must be called first.")
+        if self.index is not None:
+            return self.index.resolve(path)
+        # For multifile, / and /hivekey are just directories, and
+        # /hivekey/registry is the root key of that registry.
+        if self.multifile:
+            parts = path.strip('/').split('/', 2)
+            if not parts[0]:
+                return Node(Node.DIR, inode=1)
+            if len(parts) == 1:
+                if parts[0] not in self.hives:
+                    raise ValueError("specified item does not exist.")
+                return Node(Node.DIR, inode=2 + sorted(self.hives).index(parts[0]))
+            reg = self._hive_reg(parts[0], parts[1])
+            subpath = parts[2] if len(parts) == 3 else ''
+        else:
+            reg, subpath = self.hivefile, path
+        parent, name = os.path.split(subpath.strip('/'))
+        if not name:
+            return self._key_node(reg, self._open_key(reg, ''))
+        keyobj = self._open_key(reg, parent)
+        # Keys win over values, if there's both a key and a value by one name.
         try:
-            keyobj = reg.open(key)    # open the containing key
-            value = keyobj.value(val) # ... and extract the right value
-        except RegistryParse.RegistryStructureDoesNotExist:
-            raise ValueError("specified value does not exist")
-        return value
+            return self._key_node(reg, self._open_key(reg, subpath))
+        except ValueError:
+            pass
+        offset = self._value_offset(reg, keyobj, name)
+        if offset is None:
+            raise ValueError("specified item does not exist.")
+        node = Node(Node.VALUE, self._hive_index[reg], offset)
+        node.size = self._value_size(reg, self.record(node))
+        return node
+
+    def _value_offset(self, reg, key, filename):
+        """Return the VK record offset for a value's filename, or None.
+
+        Names are matched case-insensitively, as in the registry itself.
+
+        """
+        cachekey = (reg, key._nkrecord.offset(), self.append_extensions)
+        index = self.value_names.get(cachekey)
+        if index is None:
+            index = {}
+            for v in key.values():
+                index.setdefault(self._value_filename(v).lower(), v._vkrecord.offset())
+            self.value_names[cachekey] = index
+        return index.get(filename.lower())
+
+    def _key_node(self, reg, key):
+        """Return a Node for the given key object.
+
+        Everything here comes from the key's own NK record; the subkeys and
+        values themselves aren't looked at.
+
+        """
+        nk = key._nkrecord
+        mtime = time.mktime(key.timestamp().timetuple())
+        # A directory's size doesn't mean much anyway, so make it the number
+        # of entries in it.  Links are the usual 2 (. and the entry in the
+        # parent) plus one for each subdirectory's ..
+        subkeys = nk.subkey_number()
+        node = Node(Node.KEY, self._hive_index[reg], nk.offset(), mtime,
+                subkeys + nk.values_number())
+        node.nlink = 2 + subkeys
+        return node
+
+    def record(self, node):
+        """Return the key or value object a KEY or VALUE Node refers to."""
+        reg, hbin = self._hive(node.hive)
+        if node.kind == Node.KEY:
+            return self._key_at(reg, node.offset)
+        if node.kind == Node.VALUE:
+            return Registry.RegistryValue(RegistryParse.VKRecord(reg._buf, node.offset, hbin))
+        raise ValueError("no registry object for " + node.kind)
+
+    def _open_key(self, reg, path_to_key):
+        """Return the key object for a filesystem path within one registry file.
+
+        Resolved keys (and every parent key along the way) are stored in
+        key_cache, so this only has to walk down from the deepest parent
+        that's already known.
+
+        """
+        parts = [p for p in path_to_key.split('/') if p]
+        cachekey = lambda n: (reg, '/'.join(parts[:n]).lower())
+        depth = len(parts)
+        key = self.key_cache.get(cachekey(depth))
+        if key is not None:
+            return key
+        # Not cached; find the closest parent that is, or start at the root.
+        while depth > 0 and key is None:
+            depth -= 1
+            key = self.key_cache.peek(cachekey(depth))
+        if key is None:
+            key = reg.root()
+            self.key_cache[cachekey(0)] = key
+        for depth in range(depth, len(parts)):
+            key = self._subkey(reg, key, parts[depth])
+            if key is None:
+                raise ValueError("specified key does not exist.")
+            self.key_cache[cachekey(depth + 1)] = key
+        return key
+
+    def _subkey(self, reg, key, name):
+        """Return the subkey of a key object with the given name, or None.
+
+        This is the same case-insensitive match as RegistryKey.subkey(), but
+        it avoids parsing every subkey along the way (see SUBKEY_INDEX_MIN).
+
+        """
+        nk = key._nkrecord
+        count = nk.subkey_number()
+        if count == 0:
+            return None
+        target = name.lower()
+        if count >= self.SUBKEY_INDEX_MIN:
+            cachekey = (reg, nk.offset())
+            index = self.subkey_names.get(cachekey)
+            if index is None:
+                index = {}
+                for k in nk.subkey_list().keys():
+                    index.setdefault(k.name().lower(), k.offset())
+                self.subkey_names[cachekey] = index
+            offset = index.get(target)
+            return None if offset is None else self._key_at(reg, offset)
+        # For a short list, check the hashes first (lh lists store a hash of
+        # the uppercased name, lf lists the first four characters) and only
+        # read the names of the candidates.  The hashes are only trustworthy
+        # for plain ASCII names, so anything else just gets its names checked.
+        try:
+            name.encode("ascii")
+        except UnicodeError:
+            lh_hash, lf_hint = None, None
+        else:
+            lh_hash = _lh_hash(name)
+            lf_hint = target[:4]
+        listoff = nk.abs_offset_from_hbin_offset(nk.unpack_dword(0x1C))
+        for kind, offset, hint in _subkey_list_entries(reg._buf, listoff):
+            if kind == b"lh" and lh_hash is not None and hint != lh_hash:
+                continue
+            if kind == b"lf" and lf_hint is not None and \
+                    struct.pack("<I", hint).rstrip(b"\0").decode("latin-1").lower() != lf_hint:
+                continue
+            subkey = self._key_at(reg, offset)
+            if subkey.name().lower() == target:
+                return subkey
+        return None
+
+    def _key_at(self, reg, offset):
+        """Return the key object for the NK record at offset in a registry."""
+        hbin = self._regs[self._hive_index[reg]][1]
+        return Registry.RegistryKey(RegistryParse.NKRecord(reg._buf, offset, hbin))
 
     def _parse_reg(self, path):
         """Return the registry object and subpath for the given global path."""
@@ -190,16 +1618,97 @@ class RegistryTree():
             if len(parts) < 3:
                 raise ValueError("Can only extract objects under a specific hive.")
             hkey, regkey, path = parts
-            try:
-                reg = self.hives[hkey][regkey]
-            except KeyError:
-                raise ValueError("specified item does not exist.")
+            reg = self._hive_reg(hkey, regkey)
         else:
             reg = self.hivefile
         return reg, path
 
     def bytestr(self, path_to_value):
         """Return a byte string representation of the given value."""
+        return self._bytestr(self.value(path_to_value))
+
+    def node_bytestr(self, node):
+        """Return a byte string representation of the value a Node refers to."""
+        return self._bytestr(self.record(node))
+
+    def node_data(self, node):
+        """Return the file data for a VALUE Node, as bytes.
+
+        This is node_bytestr() with any text encoded as UTF-8, which is what
+        read() serves and what st_size counts.
+
+        """
+        return self._data(self.record(node))
+
+    def node_read(self, node, offset, size):
+        """Return up to size bytes of a VALUE Node's data, starting at offset.
+
+        This only works for values whose data is served exactly as stored
+        (RegBin and RegNone).  The bytes asked for are copied straight out
+        of the hive, from whichever big data segments they're in, so only
+        that much is read no matter how big the value is.  For anything else
+        None is returned, and node_data() has to be used instead.
+
+        """
+        value = self.record(node)
+        t = value.value_type()
+        if t != Registry.RegBin and t != Registry.RegNone:
+            return None
+        reg = self._hive(node.hive)[0]
+        cachekey = (reg, node.offset)
+        found = self.data_pieces.get(cachekey)
+        if found is None:
+            pieces = _binary_data_pieces(value._vkrecord)
+            starts = []
+            total = 0
+            for start, length in pieces:
+                starts.append(total)
+                total += length
+            found = (starts, pieces)
+            self.data_pieces[cachekey] = found
+        starts, pieces = found
+        end = offset + size
+        chunks = []
+        i = max(bisect.bisect_right(starts, offset) - 1, 0)
+        while i < len(pieces) and starts[i] < end:
+            start, length = pieces[i]
+            first = max(offset - starts[i], 0)
+            last = min(end - starts[i], length)
+            if last > first:
+                chunks.append(reg._buf[start + first:start + last])
+            i += 1
+        return b"".join(chunks)
+
+    def _data(self, value):
+        """Return node_data() for a value object."""
+        data = self._bytestr(value)
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        return data
+
+    def _value_size(self, reg, value):
+        """Return len(self._data(value)), without rendering it if possible.
+
+        Binary data is served as-is, so that's just the size of the data as
+        stored, and numbers are quick to format.  Anything else (text,
+        mostly) is rendered once and its size kept in value_sizes.
+
+        """
+        t = value.value_type()
+        if t == Registry.RegBin or t == Registry.RegNone:
+            return _binary_data_size(value._vkrecord)
+        if t == Registry.RegDWord or t == Registry.RegQWord:
+            # A number never ends in a newline, so one is always added.
+            return len(str(value.value())) + (1 if self.append_newline else 0)
+        cachekey = (reg, value._vkrecord.offset(), self.append_newline)
+        size = self.value_sizes.get(cachekey)
+        if size is None:
+            size = len(self._data(value))
+            self.value_sizes[cachekey] = size
+        return size
+
+    def _bytestr(self, value):
+        """Return a byte string representation of the given value object."""
 
         # See the documentation for VKRecord.data() in python-registry for
         # a list of data types and how they're handled by that library.
@@ -221,8 +1730,6 @@ class RegistryTree():
         #   RegBin       binary data
         #   None         ? 
         #   (Others)     ?
-        value = self.value(path_to_value)
-
         nl = "\n"
         data = value.value()
         t = value.value_type()
@@ -257,14 +1764,40 @@ class RegistryTree():
             data = data + nl
         return data
 
-    def items(self, path_to_key):
-        """Return a list of all keys and values under the given key path.
+    def items(self, path_to_key, with_stat=False, start=0):
+        """Return an iterator over all keys and values under the given key path.
         
         This also handles adding file extensions, if append_exensions is set.
+        With with_stat, each item is a (name, stat dict) pair instead, so
+        nothing has to be looked up again by name just to stat it.  (Hive
+        root keys in multifile mode get None, though, so listing /hivekey
+        doesn't load every hive.)  The first start items are skipped, so a
+        listing can be picked up where it left off.
+
+        The path is checked right away, but items are only read from the
+        registry as they're asked for, so even a huge key doesn't need them
+        all in memory at once.
         
         """
-        if not self.__loaded:
+        children = self.children(path_to_key, with_stat, start)
+        if with_stat:
+            return ((name, None if node is None else self.node_stat(node))
+                    for name, node in children)
+        return (name for name, node in children)
+
+    def children(self, path_to_key, with_nodes=True, start=0):
+        """Return an iterator of (name, Node) for everything under a key path.
+
+        This is what's behind items().  Without with_nodes the Nodes may be
+        left as None, which saves working out sizes and such when only the
+        names are wanted.  Hive root keys in multifile mode are always None
+        (see items()).
+
+        """
+        if not self._loaded:
             raise ValueError("load() must be called first.")
+        if self.index is not None:
+            return self.index.children(path_to_key, start)
         # For multifile:
         #   Case 1: /hivekey/registry/path
         #   Case 2: /hivekey/registry
@@ -274,82 +1807,226 @@ class RegistryTree():
             parts = path_to_key.strip('/').split('/', 2)
             if len(parts) >= 3:
                 hkey, regkey, subpath = parts
-                try:
-                    reg = self.hives[hkey][regkey]
-                except KeyError:
-                    raise ValueError("specified key does not exist.")
-                return self._items_for_reg(reg, subpath)
+                reg = self._hive_reg(hkey, regkey)
+                return self._items_for_reg(reg, subpath, with_nodes, start)
             if len(parts) == 2:
                 hkey, regkey = parts
                 subpath = '/'
-                try:
-                    reg = self.hives[hkey][regkey]
-                except KeyError:
-                    raise ValueError("specified key does not exist.")
-                return self._items_for_reg(reg, subpath) 
+                reg = self._hive_reg(hkey, regkey)
+                return self._items_for_reg(reg, subpath, with_nodes, start)
             if len(parts) == 1 and parts[0]:
                 try:
-                    return self.hives[parts[0]].keys()
+                    names = list(self.hives[parts[0]].keys())[start:]
                 except KeyError:
                     raise ValueError("specified key does not exist.")
-            return self.hives.keys()
-        return self._items_for_reg(self.hivefile, path_to_key)
+                return iter([(name, None) for name in names])
+            names = list(self.hives.keys())[start:]
+            return iter([(name, self._resolve("/" + name)) for name in names])
+        return self._items_for_reg(self.hivefile, path_to_key, with_nodes, start)
 
-    def _items_for_reg(self, reg, path_to_key):
-        try:
-            key = reg.open(self._path_to_regpath(path_to_key))
-        except RegistryParse.RegistryStructureDoesNotExist:
-            raise ValueError("specified key does not exist.")
-        names = []
-        # Convert these into names.  how do I do "map" in python, again?
-        for k in key.subkeys():
-            names.append(k.name())
+    def _items_for_reg(self, reg, path_to_key, with_nodes=False, start=0):
+        key = self._open_key(reg, path_to_key)
+        return self._iter_items(reg, key, with_nodes, start)
+
+    def _iter_items(self, reg, key, with_nodes, start):
+        """Generator behind _items_for_reg(): subkeys first, then values.
+
+        This goes through the subkey and value lists directly instead of
+        using subkeys() and values(), which would build the whole lists.
+
+        """
+        nk = key._nkrecord
+        hive = self._hive_index[reg]
+        hbin = self._regs[hive][1]
+        count = nk.subkey_number()
+        node = None
+        if start < count:
+            listoff = nk.abs_offset_from_hbin_offset(nk.unpack_dword(0x1C))
+            for kind, offset, hint in _subkey_list_entries(reg._buf, listoff, start):
+                k = self._key_at(reg, offset)
+                if with_nodes:
+                    node = self._key_node(reg, k)
+                yield k.name(), node
         # Include values in this list also.
         # Add an extension for the "fileytpe" if that option is set.
-        for v in key.values():
-            name = v.name()
-            if self.append_extensions:
-                name = name + "." + v.value_type_str()
-            names.append(name)
-        return names
+        for offset in _value_list_entries(reg._buf, nk, max(start - count, 0)):
+            v = Registry.RegistryValue(RegistryParse.VKRecord(reg._buf, offset, hbin))
+            if with_nodes:
+                node = Node(Node.VALUE, hive, offset)
+                node.size = self._value_size(reg, v)
+            yield self._value_filename(v), node
+
+    def walk(self, path="/", depth=None, depth_first=False):
+        """Yield (path, Node) for a path and everything under it, breadth-first.
+
+        With depth given, nothing more than that many levels below path is
+        included.  Anything that can't be looked up (a hive that won't load,
+        say) is left out, along with everything under it.  Each path is
+        yielded as soon as it's found, so a big directory doesn't have to be
+        gone through all at once.  Everything found goes in paths, as if it
+        had been looked up with resolve().
+
+        With depth_first, everything under a key comes right after it instead
+        (subkeys and all their contents first, then values), the way tar
+        lays things out.  Then only the keys on the way down to the current
+        one are held onto, so memory use doesn't grow with the tree.
+
+        """
+        node = self.resolve(path)
+        yield path, node
+        if depth_first:
+            children = self._walk_depth_first(path, node, depth)
+        else:
+            children = self._walk_breadth_first(path, node, depth)
+        for childpath, child in children:
+            self.paths[self._path_key(childpath)] = child
+            yield childpath, child
+
+    def _walk_children(self, path):
+        """Yield (path, Node) for what's directly under a key path, for walk()."""
+        for name, child in self.children(path):
+            childpath = path.rstrip('/') + '/' + name
+            if child is None:
+                try:
+                    child = self.resolve(childpath)
+                except ValueError:
+                    continue
+            yield childpath, child
+
+    def _walk_breadth_first(self, path, node, depth):
+        queue = deque([(path, node, 0)])
+        while queue:
+            path, node, level = queue.popleft()
+            if node.kind == Node.VALUE or level == depth:
+                continue
+            for childpath, child in self._walk_children(path):
+                yield childpath, child
+                queue.append((childpath, child, level + 1))
+
+    def _walk_depth_first(self, path, node, depth):
+        if node.kind == Node.VALUE or depth == 0:
+            return
+        stack = [(self._walk_children(path), 1)]
+        while stack:
+            children, level = stack[-1]
+            for childpath, child in children:
+                yield childpath, child
+                if child.kind != Node.VALUE and level != depth:
+                    stack.append((self._walk_children(childpath), level + 1))
+                    break
+            else:
+                stack.pop()
+
+    def export(self, out, path="/", format="tar", depth=None, finish=True):
+        """Write a path and everything under it to a binary file object.
+
+        format is one of:
+
+            tar     a tar archive, laid out just like the mounted filesystem
+                    (names relative to /, the same attributes stat() gives
+                    and the same data read() serves)
+            jsonl   one JSON object per line, from export_records()
+
+        The tree is gone through once, depth-first (down to depth levels
+        below path, if given), and everything is written out as it's found,
+        so out can be a pipe and memory use stays flat no matter how much
+        there is.  With finish false, a tar archive's end-of-archive marker
+        is left off, so that more can be written after it to make one big
+        archive (see batch_export()).  Returns the number of entries written.
+
+        """
+        count = 0
+        if format == "jsonl":
+            for record in self.export_records(path, depth):
+                out.write(json.dumps(record, sort_keys=True).encode("utf-8") + b"\n")
+                count += 1
+            return count
+        if format != "tar":
+            raise ValueError("unknown export format: " + str(format))
+        # The headers and data are written here directly rather than through
+        # TarFile, which keeps every member it's written in a list.  They're
+        # in GNU rather than POSIX format, since the latter adds an extra
+        # header for every non-integer mtime, which doubles the time this
+        # takes.
+        for itempath, node in self.walk(path, depth, depth_first=True):
+            name = itempath.strip('/')
+            if not name:
+                continue
+            st = self.node_stat(node)
+            info = tarfile.TarInfo(name)
+            info.mode = stat.S_IMODE(st["st_mode"])
+            info.mtime = int(st["st_mtime"])
+            if node.kind == Node.VALUE:
+                info.size = st["st_size"]
+            else:
+                info.type = tarfile.DIRTYPE
+            out.write(info.tobuf(tarfile.GNU_FORMAT, "utf-8", "replace"))
+            if info.size:
+                data = _NodeFile(self, node)
+                while True:
+                    chunk = data.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                out.write(b"\0" * (-info.size % tarfile.BLOCKSIZE))
+            count += 1
+        if finish:
+            out.write(_TAR_END)
+        return count
+
+    def export_records(self, path="/", depth=None):
+        """Yield a dict for a path and everything under it (to depth), depth-first.
+
+        Each has the item's path, kind ("key" or "value"), mtime and size as
+        stat() gives them, and for values the data type ("RegSZ" and so on)
+        and the data as read() serves it: "data" if it's UTF-8 text,
+        otherwise "data_base64".
+
+        """
+        for itempath, node in self.walk(path, depth, depth_first=True):
+            st = self.node_stat(node)
+            record = {"path": itempath, "mtime": st["st_mtime"],
+                    "size": st["st_size"]}
+            if node.kind == Node.VALUE:
+                record["kind"] = "value"
+                record["type"] = self.record(node).value_type_str()
+                data = self.node_data(node)
+                try:
+                    record["data"] = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    record["data_base64"] = base64.b64encode(data).decode("ascii")
+            else:
+                record["kind"] = "key"
+            yield record
 
     def stat(self, path):
+        """Return a dict of file attributes for the given path."""
+        return self.node_stat(self.resolve(path))
+
+    def node_stat(self, node):
+        """Return a dict of file attributes for the given Node."""
         st = self._reg_object_stat()
+        st["st_ino"] = node.inode
+        st["st_nlink"] = node.nlink
+        st["st_size"] = node.size
         # Key (emulated directory)
-        # If this works, we can just stick with the defaults for a directory
-        try:
-            items = self.items(path)
+        # We can just stick with the defaults for a directory, plus the
+        # modification time if it's a real key.  (If it's not, e.g. a hivekey,
+        # the Node's mtime is just the default.)
         # Otherwise, Value (emulate file)
-        except ValueError:
-            data = self.bytestr(path)
+        if node.kind == Node.VALUE:
             st["st_mode"] = stat.S_IFREG | 0o644 # regular file, rw-r--r--
-            st["st_nlink"] = 1 # just one hard link for our regular files
-            st["st_size"] = len(data)
-        # Oh, and if it was a real key, we can get the modification time.
-        # (The runaround with the time functions is required to convert
-        # the datetime object into the integer FUSE expects.)  If it wasn't a
-        # real key (e.g., hivekey) just stick with the default.
         else:
-            try:
-                key = self.key(path)
-            except ValueError:
-                pass
-            else:
-                st["st_mtime"] = time.mktime(key.timestamp().timetuple())
+            st["st_mtime"] = node.mtime
         return st
 
     # Some utilities
 
-    def _path_to_regpath(self, path):
-        """Convert a filesystem path into a vaild registry path."""
-        # All thsi actually does is swap the slashes.
-        return path.lstrip('/').replace("/","\\")
-
-    def _filename_to_regvalue(self, name):
-        """Convert a filename into a valid registry value name."""
-        # All this actually does is trim off the extension, if there is one.
+    def _value_filename(self, value):
+        """Return the filename to use for a value object."""
+        name = value.name()
         if self.append_extensions:
-            name = name.rsplit('.', 1)[0] 
+            name = name + "." + value.value_type_str()
         return name
 
     def _reg_object_stat(self):
@@ -360,7 +2037,7 @@ class RegistryTree():
         # get involved in tracking access times here!)
         s = dict()
         s["st_mode"]  = stat.S_IFDIR | 0o755 # defaulting to drwxr-xr-x
-        s["st_ino"]   = 0 # inode number.  I think we can leave this at 0.
+        s["st_ino"]   = 0 # inode number.  Filled in from the Node.
         s["st_dev"]   = 0 # device ID.  Dito for this one.
         s["st_nlink"] = 2 # 2 hard links -- a good default for directories.
         s["st_uid"]   = 0 # user is root by default
@@ -372,6 +2049,301 @@ class RegistryTree():
         return s
 
 
+def _image_names(images):
+    """Return a directory name for each image (hivefile or directory) in a list.
+
+    Each is named after its file, with -2, -3 and so on added to any that
+    come up more than once.
+
+    """
+    names = []
+    for image in images:
+        name = base = os.path.basename(os.path.abspath(image))
+        n = 1
+        while name in names:
+            n += 1
+            name = "%s-%d" % (base, n)
+        names.append(name)
+    return names
+
+
+class _SharedRegistries(object):
+    """Registry objects for a RegistryForest, one per distinct hive file.
+
+    Hive files with exactly the same contents (the same SOFTWARE hive in
+    several cloned images, say) all get the first one's Registry, so it's
+    only held in memory once, and everything cached about it is shared too.
+    Files are only hashed when there's already another one the same size,
+    and they're hashed by reading them, so a duplicate is never opened and
+    a mapped hive isn't paged in just to be compared.  (Within one image,
+    each file still gets its own, since a RegistryTree tells its hives
+    apart by their Registry objects.)
+
+    Opening and hashing happen outside the lock, so one big hive doesn't
+    hold up the first access to every other one.  If two copies of the same
+    file are opened at the same moment, they may just each get their own.
+
+    """
+    def __init__(self):
+        self.opened = 0 # Distinct Registry objects handed out
+        self.shared = 0 # Times one was handed out again for another file
+        self._by_size = {} # file size -> [[sha1 digest or None, path, Registry], ...]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(path):
+        """Return the sha1 digest of a file's contents."""
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for piece in iter(lambda: f.read(1024 * 1024), b""):
+                sha1.update(piece)
+        return sha1.digest()
+
+    def open(self, path, opener, taken=()):
+        """Return a Registry for path, calling opener(path) if it's a new one.
+
+        Registries in taken aren't handed out again.
+
+        """
+        size = os.stat(path).st_size
+        with self._lock:
+            same = list(self._by_size.get(size, ()))
+        digest = None
+        if same:
+            digest = self._digest(path)
+            for entry in same:
+                if entry[0] is None:
+                    entry[0] = self._digest(entry[1])
+                if entry[0] == digest and entry[2] not in taken:
+                    with self._lock:
+                        self.shared += 1
+                    return entry[2]
+        reg = opener(path)
+        with self._lock:
+            self._by_size.setdefault(size, []).append([digest, path, reg])
+            self.opened += 1
+        return reg
+
+
+class _ForestTree(RegistryTree):
+    """One image's RegistryTree in a RegistryForest."""
+
+    def __init__(self, registries):
+        RegistryTree.__init__(self)
+        self.registries = registries # _SharedRegistries
+
+    def _open_registry(self, path):
+        opener = lambda path: RegistryTree._open_registry(self, path)
+        return self.registries.open(path, opener, self._hive_index)
+
+
+def _forest_setting(name):
+    """Return a property for a RegistryForest setting that all its trees follow."""
+    def get(self):
+        return self._settings[name]
+    def set(self, value):
+        self._settings[name] = value
+        for tree in self.trees.values():
+            setattr(tree, name, value)
+    return property(get, set)
+
+
+class RegistryForest(RegistryTree):
+    """Several registries (images) in one tree, each in its own directory.
+
+    1. Create a RegistryForest() object
+    2. Call load() with a list of hivefiles and directories
+    3. Use it just like a RegistryTree, with paths like /<image>/Software
+
+    Each image gets a RegistryTree of its own (in trees, by directory name),
+    but they're set up to share as much as they can: hive files with the
+    same contents are only opened once between them (see
+    _SharedRegistries), and there's just the one set of caches for all of
+    them, so the cache sizes are limits for everything together rather than
+    for each image.  The caches kept by parsed registry (key_cache and so
+    on) are handed down to the trees; the ones kept by path or inode number
+    (paths, missing, inodes) stay up here, where the paths are whole.
+
+    Nodes for keys and values have their hive numbered across all the
+    images, so inode numbers stay distinct; directories get the image's
+    number in their inode number instead.
+
+    """
+    # Settings passed down to every image's tree
+    SETTINGS = ("append_extensions", "append_newline", "use_mmap")
+    # The caches that are kept here, by path or inode number, instead of
+    # being shared with the trees
+    PATH_CACHES = ("inodes", "missing", "paths")
+
+    append_extensions = _forest_setting("append_extensions")
+    append_newline = _forest_setting("append_newline")
+    use_mmap = _forest_setting("use_mmap")
+
+    def __init__(self):
+        self._settings = {}
+        self.trees = OrderedDict() # image directory name -> RegistryTree
+        RegistryTree.__init__(self)
+        self.multifile = False
+        self.hivefile = None
+        self.registries = _SharedRegistries()
+        self._images = {} # image directory name -> (number, tree)
+        self._members = [] # the trees again, by number
+        self._bases = [] # first forest-wide hive number for each tree
+        self._hive_files = []
+        self._snapshots = False
+
+    def load(self, images):
+        """Load each of a list of registries, as RegistryTree.load() would.
+
+        Raises ValueError naming the first one that can't be loaded.
+
+        """
+        self._loaded = False
+        self.source = list(images)
+        self.trees = OrderedDict()
+        self.registries = _SharedRegistries()
+        self._images = {}
+        self._members = []
+        self._bases = []
+        self._hive_files = []
+        self._snapshots = False
+        for name in self.CACHES:
+            getattr(self, name).clear()
+        for name, image in zip(_image_names(images), images):
+            tree = _ForestTree(self.registries)
+            for setting in self.SETTINGS:
+                setattr(tree, setting, getattr(self, setting))
+            try:
+                tree.load(image)
+            except Exception:
+                raise ValueError('"' + image + '"' +
+                        " could not be loaded as a registry hivefile or directory")
+            for cache in self.CACHES:
+                if cache in self.PATH_CACHES:
+                    getattr(tree, cache).size = 0
+                else:
+                    setattr(tree, cache, getattr(self, cache))
+            self._images[name] = (len(self._members), tree)
+            self._members.append(tree)
+            self.trees[name] = tree
+            self._bases.append(len(self._hive_files))
+            self._hive_files.extend(tree._hive_files)
+        self._loaded = True
+
+    def changed(self):
+        """True if any file any image was loaded from has changed since."""
+        return any(tree.changed() for tree in self.trees.values())
+
+    def reloaded(self):
+        """Return a new forest with the same settings, loaded from the same images."""
+        forest = RegistryForest()
+        for setting in self.SETTINGS:
+            setattr(forest, setting, getattr(self, setting))
+        for name in self.CACHES:
+            getattr(forest, name).size = getattr(self, name).size
+        forest.load(self.source)
+        if self._snapshots:
+            forest.take_snapshot()
+        return forest
+
+    def reload(self):
+        """Load the same images again, for when changed() says so."""
+        forest = self.reloaded()
+        self.__dict__.update(forest.__dict__)
+
+    def take_snapshot(self):
+        """Take a RegistrySnapshot of each image's tree (see RegistryTree)."""
+        for tree in self.trees.values():
+            tree.take_snapshot()
+        self._snapshots = True
+
+    def use_index(self, filename):
+        raise ValueError("a single index can't be used for several images.")
+
+    def use_default_indexes(self):
+        """Have each image use its index from the default place, if it has a good one."""
+        for tree in self.trees.values():
+            indexfile = RegistryIndex.default_path(tree.source)
+            if os.path.exists(indexfile):
+                try:
+                    tree.use_index(indexfile)
+                except (ValueError, EnvironmentError):
+                    pass
+
+    def _image(self, path):
+        """Return (number, tree, path within it) for a path under an image."""
+        parts = path.strip('/').split('/', 1)
+        try:
+            number, tree = self._images[parts[0]]
+        except KeyError:
+            raise ValueError("specified item does not exist.")
+        return number, tree, "/" + (parts[1] if len(parts) > 1 else "")
+
+    def _member_hive(self, index):
+        """Return (number, tree, hive within it) for a forest-wide hive number."""
+        number = bisect.bisect_right(self._bases, index) - 1
+        if number < 0 or index >= len(self._hive_files):
+            raise ValueError("no such hive.")
+        return number, self._members[number], index - self._bases[number]
+
+    def _global(self, number, node):
+        """Return the forest's Node for an image's Node."""
+        if node.kind == Node.DIR:
+            found = Node(Node.DIR, inode=(number + 1) << 8 | node.inode)
+        else:
+            found = Node(node.kind, self._bases[number] + node.hive,
+                    node.offset, node.mtime, node.size)
+        found.nlink = node.nlink
+        return found
+
+    def _local(self, node):
+        """Return (tree, the image's own Node) for one of the forest's Nodes."""
+        number, tree, hive = self._member_hive(node.hive)
+        local = Node(node.kind, hive, node.offset, node.mtime, node.size)
+        local.nlink = node.nlink
+        return tree, local
+
+    def _resolve(self, path):
+        if not self._loaded:
+            raise ValueError("load() must be called first.")
+        if not path.strip('/'):
+            return Node(Node.DIR, inode=1)
+        number, tree, subpath = self._image(path)
+        return self._global(number, tree.resolve(subpath))
+
+    def children(self, path_to_key, with_nodes=True, start=0):
+        if not self._loaded:
+            raise ValueError("load() must be called first.")
+        if not path_to_key.strip('/'):
+            names = list(self.trees)[start:]
+            return iter([(name, self._resolve("/" + name)) for name in names])
+        number, tree, subpath = self._image(path_to_key)
+        return ((name, None if node is None else self._global(number, node))
+                for name, node in tree.children(subpath, with_nodes, start))
+
+    def node(self, inode):
+        node = self.inodes.get(inode)
+        if node is not None:
+            return node
+        hive, offset = Node.split_inode(inode)
+        number, tree, local = self._member_hive(hive)
+        node = self._global(number, tree.node(Node.inode_for(local, offset)))
+        self.inodes[inode] = node
+        return node
+
+    def key(self, path_to_key):
+        number, tree, subpath = self._image(path_to_key)
+        return tree.key(subpath)
+
+    def record(self, node):
+        tree, local = self._local(node)
+        return tree.record(local)
+
+    def _hive(self, index):
+        number, tree, hive = self._member_hive(index)
+        return tree._hive(hive)
+
+
 class WinRegFS(fuse.Operations):
     """Collection of filesystem operations for interfacing with the registry.
     
@@ -383,6 +2355,15 @@ class WinRegFS(fuse.Operations):
     def __init__(self):
         self.foreground = False # Stay in foreground when mounting FS?
         self.debug = False # Show debug output (implies foreground)?
+        self.handles = FileHandles() # Open files and their data
+        self.immutable = True # Assume the hivefile won't change while mounted?
+        self.threads = None # Most FS operations to run at once (None: no limit)
+        self._checked = 0 # When we last looked for changes (if not immutable)
+        self._check_lock = threading.Lock()
+        self._slots = None # Semaphore for self.threads, once mounted
+        self.prefetcher = None # Prefetcher to start once mounted, if any
+        self.stats = None # OpStats, if counting operations (see STATS_DIR)
+        self.tracer = None # Tracer, if writing down every operation
 
     def _check_if_mounted(self):
         """True if the filesystem is curently mounted, False otherwise."""
@@ -407,16 +2388,58 @@ class WinRegFS(fuse.Operations):
     mounted = property(_check_if_mounted)
     """True if the filesystem is currently mounted, False otherwise."""
 
+    # Where the stats files are when stats are on: stats (the summary from
+    # OpStats, as JSON) and reset (opening that starts the counts over).
+    # It's left out of listings of /, but it's there for anyone who knows
+    # to look.
+    STATS_DIR = "/.winregfs"
+    STATS_FILES = ("stats", "reset")
+    # Inode numbers for STATS_DIR and its files, well clear of the small
+    # ones RegistryTree gives its own directories.
+    STATS_INODE = 0xFFFFFF00
+
+    # How long (in seconds) the kernel can hold on to names and attributes
+    # when the image is immutable.  Nothing ever changes, so this could be
+    # forever, really.
+    CACHE_TIMEOUT = 3600
+
+    # How often (in seconds) to check the hivefile for changes when it isn't
+    # immutable.
+    CHECK_INTERVAL = 1.0
+
     def setup(self, hivefile, mountpoint, append_newline=None,
-            append_extensions=None, foreground=None, debug=None, options=None):
-        """Parse given mount settings into attributes and open the hivefile."""
+            append_extensions=None, cache_size=None, buffer_size=None,
+            immutable=None, use_mmap=None, threads=None, index=None,
+            snapshot=None, prefetch=None, stats=None, trace=None,
+            foreground=None, debug=None, options=None):
+        """Parse given mount settings into attributes and open the hivefile.
+
+        hivefile can also be a list of them, to mount them all together as a
+        RegistryForest, with a directory for each.
+
+        """
         ### Parse and check the hivefile and mountpoint
-        hivefile = os.path.abspath(hivefile)
-        self.tree = RegistryTree()
+        if isinstance(hivefile, (list, tuple)):
+            hivefile = [os.path.abspath(image) for image in hivefile]
+            self.tree = RegistryForest()
+        else:
+            hivefile = os.path.abspath(hivefile)
+            self.tree = RegistryTree()
+        if immutable != None:
+            self.immutable = _yes(immutable)
+        if use_mmap != None:
+            self.tree.use_mmap = _yes(use_mmap)
+        elif not self.immutable:
+            # A mapped file that's truncated in place gets us killed with
+            # SIGBUS on the next read past its new end, so if the file might
+            # change, just read it unless told otherwise.
+            self.tree.use_mmap = False
         try:
             self.tree.load(hivefile)
             # TODO only catch intended exceptions!
-        except Exception:
+        except Exception as e:
+            if isinstance(self.tree, RegistryForest):
+                raise ValueError(str(e)) # It says which one
             raise ValueError('"' + hivefile + '"' +
                     " could not be loaded as a registry hivefile or directory")
         self.mountpoint = os.path.abspath(mountpoint)
@@ -432,9 +2455,55 @@ class WinRegFS(fuse.Operations):
         # otherwise, for example.  append_newline could also have a choice
         # between never, auto, and always for different situations.
         if append_newline != None:
-            self.tree.append_newline = append_newline
+            self.tree.append_newline = _yes(append_newline)
         if append_extensions != None:
-            self.tree.append_extensions = append_extensions
+            self.tree.append_extensions = _yes(append_extensions)
+        # Use a prebuilt index if one was given, or if there's one in the
+        # default place.  (A stale one in the default place is just ignored,
+        # since the hivefile may well have been updated since.)
+        if isinstance(self.tree, RegistryForest):
+            if index:
+                raise ValueError("--index can't be used with more than one image")
+            self.tree.use_default_indexes()
+            indexfile = None
+        else:
+            indexfile = index or RegistryIndex.default_path(hivefile)
+        if indexfile and (index or os.path.exists(indexfile)):
+            try:
+                self.tree.use_index(indexfile)
+            except (ValueError, EnvironmentError) as e:
+                if index:
+                    raise ValueError(str(e))
+        if snapshot != None and _yes(snapshot):
+            self.tree.take_snapshot()
+        if cache_size != None:
+            self.tree.key_cache.size = cache_size
+        if buffer_size != None:
+            self.handles.budget = buffer_size * 1024 * 1024
+        if threads != None:
+            self.threads = threads
+        if stats != None and _yes(stats):
+            self.stats = OpStats()
+        if trace != None:
+            try:
+                self.tracer = Tracer(os.path.abspath(trace))
+            except EnvironmentError as e:
+                raise ValueError('"' + trace + '"' + " can't be written: " + str(e))
+        if prefetch != None and prefetch != "no":
+            # Either "yes", or limits like "depth:4,mem:256M"
+            self.prefetcher = Prefetcher()
+            try:
+                for limit in prefetch.split(','):
+                    name, val = limit.partition(':')[::2]
+                    if name == "depth":
+                        self.prefetcher.depth = int(val)
+                    elif name == "mem":
+                        self.prefetcher.budget = _size(val)
+                    elif name != "yes":
+                        raise ValueError(name)
+            except ValueError:
+                raise ValueError('"' + prefetch + '"' +
+                        " isn't a prefetch setting (try yes, or depth:N,mem:SIZE)")
         if foreground != None:
             self.foreground = foreground
         if debug != None:
@@ -446,8 +2515,27 @@ class WinRegFS(fuse.Operations):
         self.fuse_options = options or {}
         # Default to setting the filesystem name to the hivefile,
         # unless one has been specified explicitly.
-        if not self.fuse_options.has_key("fsname"):
-           self.fuse_options["fsname"] = hivefile
+        if "fsname" not in self.fuse_options:
+           if isinstance(self.tree, RegistryForest):
+               self.fuse_options["fsname"] = "winregfs"
+           else:
+               self.fuse_options["fsname"] = hivefile
+        # Our inode numbers are stable, so let the kernel use them.
+        self.fuse_options.setdefault("use_ino", True)
+        # If the hivefile won't change under us, nothing we say will ever go
+        # stale, so the kernel can keep names, attributes, missing names and
+        # file contents for as long as it likes instead of asking us again.
+        # Otherwise stick with fuse's defaults (about a second) so changes
+        # show up.
+        if self.immutable:
+            for name in ("entry_timeout", "attr_timeout", "negative_timeout"):
+                self.fuse_options.setdefault(name, self.CACHE_TIMEOUT)
+            self.fuse_options.setdefault("kernel_cache", True)
+        else:
+            # fuse doesn't cache missing names at all by default.  That's safe
+            # for a short while here too, since changes are only checked for
+            # every CHECK_INTERVAL anyway.
+            self.fuse_options.setdefault("negative_timeout", self.CHECK_INTERVAL)
         # "rw" isn't an option right now.
         self.fuse_options["ro"] = True
 
@@ -467,12 +2555,21 @@ class WinRegFS(fuse.Operations):
         # 
         # I imagine there's probably a much better way to do this, but I'm
         # not sure what it is.
+        #
+        # With threads set to 1, fuse runs single-threaded.  Otherwise it
+        # runs multithreaded, and if there's a limit __call__() makes sure
+        # no more than that many operations run at once.
         child_pid = 0
         if not self.foreground:
             child_pid = os.fork()
         if not child_pid: # PID is 0; either child process or we're not forking.
-            fuse.FUSE(self, self.mountpoint, foreground=self.foreground,
-                    debug=self.debug, **self.fuse_options)
+            if self.threads and self.threads > 1:
+                self._slots = threading.BoundedSemaphore(self.threads)
+            # raw_fi gives open() the fuse_file_info itself, so it can set
+            # keep_cache and such along with the handle.
+            _FUSE(self, self.mountpoint, raw_fi=True,
+                    foreground=self.foreground, debug=self.debug,
+                    nothreads=(self.threads == 1), **self.fuse_options)
 
     def unmount(self):
         """Unmount the filesystem."""
@@ -493,45 +2590,338 @@ class WinRegFS(fuse.Operations):
     # for write operations, so no changes are needed.
 
 
-    def getattr(self, path, fh=None):
-        """Return a dict of file attributes for the given file/directory."""
-        # This will work for either file or directory, but raises ValueError if
-        # it doesn't exist-- convert that error to ENOENT if it happens.
+    def __call__(self, op, *args):
+        """Run a filesystem operation, waiting for a free slot if threads is set.
+
+        Any prefetching is held off until it's done, and it's counted in
+        stats if those are on.
+
+        """
+        prefetcher = self.prefetcher
+        stats = self.stats
+        tracer = self.tracer
+        slots = self._slots
+        if prefetcher is not None:
+            prefetcher.begin()
+        timed = stats is not None or tracer is not None
+        if timed:
+            start = _clock()
+        # readdir() hands back its entries lazily, and most of the work
+        # happens as they're taken, after we've returned; its slot is held,
+        # and prefetching held off, until then.
+        listing = False
+        if slots is not None:
+            slots.acquire()
+        try:
+            result = super(WinRegFS, self).__call__(op, *args)
+            listing = op == "readdir"
+        except Exception as e:
+            if timed:
+                elapsed = _clock() - start
+                if stats is not None:
+                    stats.add(op, elapsed, error=True)
+                if tracer is not None:
+                    tracer.record(op, args, start, elapsed,
+                            getattr(e, "errno", None) or errno.EIO)
+            raise
+        finally:
+            if not listing:
+                if slots is not None:
+                    slots.release()
+                if prefetcher is not None:
+                    prefetcher.end()
+        if listing:
+            if timed:
+                result = self._timed(op, args, start, result)
+            if slots is not None:
+                result = self._until_done(result, slots.release)
+            if prefetcher is not None:
+                result = self._until_done(result, prefetcher.end)
+        elif timed:
+            elapsed = _clock() - start
+            if stats is not None:
+                stats.add(op, elapsed, len(result) if op == "read" else 0)
+            if tracer is not None:
+                tracer.record(op, args, start, elapsed)
+        return result
+
+    def _until_done(self, entries, done):
+        """Pass entries along, and call done() once they're done with."""
+        try:
+            for entry in entries:
+                yield entry
+        finally:
+            done()
+
+    def _timed(self, op, args, start, entries):
+        """Pass entries along, and count op's time once they're done with."""
+        count = 0
+        try:
+            for entry in entries:
+                count += 1
+                yield entry
+        finally:
+            elapsed = _clock() - start
+            if self.stats is not None:
+                self.stats.add(op, elapsed)
+            if self.tracer is not None:
+                self.tracer.record(op, args, start, elapsed, count=count)
+
+    def _stats_file(self, path):
+        """Return which stats file a path is ("" for STATS_DIR), or None.
+
+        Raises ENOENT for anything else in STATS_DIR.  Without stats on,
+        there's no such thing.
+
+        """
+        if self.stats is None:
+            return None
+        if path == self.STATS_DIR:
+            return ""
+        if path.startswith(self.STATS_DIR + "/"):
+            name = path[len(self.STATS_DIR) + 1:]
+            if name in self.STATS_FILES:
+                return name
+            raise fuse.FuseOSError(errno.ENOENT)
+        return None
+
+    def _stats_node(self, name):
+        """Return a Node to stat() for a stats file (or STATS_DIR)."""
+        if name == "":
+            return Node(Node.DIR, mtime=self.stats.since, inode=self.STATS_INODE)
+        inode = self.STATS_INODE + 1 + self.STATS_FILES.index(name)
+        # Sizes change, so they're reported as 0 and the files are opened
+        # with direct_io, which reads them until they run out.
+        return Node(Node.VALUE, inode=inode)
+
+    def _stats_data(self, name):
+        """Return the contents of a stats file."""
+        if name != "stats":
+            return b""
+        summary = self.stats.summary(self.tree)
+        summary["handles"] = {"open": len(self.handles),
+                "buffered_bytes": self.handles.used,
+                "budget": self.handles.budget}
+        if self.prefetcher is not None:
+            summary["prefetch"] = {"visited": self.prefetcher.visited,
+                    "error": self.prefetcher.error}
+        return (json.dumps(summary, indent=1, sort_keys=True) + "\n").encode("utf-8")
+
+    def init(self, path):
+        """Start prefetching and tracing, if set up, now that the filesystem is mounted."""
+        # (A prebuilt index or snapshot has nothing left to warm up.)
+        if self.prefetcher is not None and self.tree.index is None:
+            self.prefetcher.start(self.tree)
+        if self.tracer is not None:
+            self.tracer.start()
+
+    def destroy(self, path):
+        """Stop any prefetching, and finish any trace, on the way out."""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    def _requester(self):
+        """Return the (uid, gid) of whoever asked for the current operation.
+
+        Outside of a real request (operations called directly, as
+        winregfs_bench.py does), that's whoever is running this.
+
+        """
+        try:
+            return tuple(fuse.fuse_get_context()[0:2])
+        except ValueError:
+            # fuse_get_context() dereferences a NULL context then.
+            return os.getuid(), os.getgid()
+
+    def _check_source(self):
+        """Reload the tree if the hivefile has changed (unless it's immutable).
+
+        The new tree replaces the old one all at once, so other threads
+        see one or the other.  Open handles are dropped on a reload, since
+        their Nodes point into the old file.  If the new one can't be
+        loaded (say, it's still being written), the old one stays and it's
+        tried again next time.
+
+        """
+        if self.immutable:
+            return
+        now = time.time()
+        if now - self._checked < self.CHECK_INTERVAL:
+            return
+        with self._check_lock:
+            if now - self._checked < self.CHECK_INTERVAL:
+                return # Another thread just did it
+            self._checked = now
+            if self.tree.changed():
+                try:
+                    tree = self.tree.reloaded()
+                except Exception:
+                    return
+                self.handles.clear()
+                self.tree = tree
+
+    def _resolve(self, path, fh=None):
+        """Return the tree's Node for path, or raise ENOENT if there isn't one.
+
+        If a file handle from open() is given, the Node is found by that
+        instead.  With raw_fi (see mount()) the "handle" is really a
+        fuse_file_info, so the number is taken out of that.
+
+        """
+        fh = getattr(fh, "fh", fh)
+        if fh:
+            try:
+                return self.handles.node(fh)
+            except KeyError:
+                raise fuse.FuseOSError(errno.EBADF)
+        if self.stats is not None:
+            start = _clock()
         try:
-            st = self.tree.stat(path)
+            return self.tree.resolve(path)
         except ValueError:
             raise fuse.FuseOSError(errno.ENOENT)
+        finally:
+            if self.stats is not None:
+                self.stats.add("tree.resolve", _clock() - start)
+
+    def getattr(self, path, fh=None):
+        """Return a dict of file attributes for the given file/directory."""
+        # This will work for either file or directory, but raises ENOENT if
+        # it doesn't exist.
+        self._check_source()
+        name = self._stats_file(path)
+        if name is not None:
+            node = self._stats_node(name)
+        else:
+            node = self._resolve(path, fh)
+        st = self.tree.node_stat(node)
         # Apply UID and GID from fuse's context.  The other values are fine
         # as-is.
-        st["st_uid"], st["st_gid"] = fuse.fuse_get_context()[0:2]
+        st["st_uid"], st["st_gid"] = self._requester()
         return st
 
-    def readdir(self, path, fh):
-        """Return a list of all items in the given path (including . and ..)."""
-        dirents = ['.', '..']
-        dirents.extend(self.tree.items(path))
-        return dirents
+    def readdir(self, path, fh, offset=0):
+        """Return an iterator over all items in the given path (including . and ..).
+
+        Each item is (name, attributes, offset), where offset is where to
+        start the next readdir() from to carry on after that item.  (See
+        _FUSE below for how the offset gets here.)
+
+        """
+        self._check_source()
+        name = self._stats_file(path)
+        if name is not None:
+            if name:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+            return self._stats_dirents(offset)
+        if self._resolve(path).kind == Node.VALUE:
+            raise fuse.FuseOSError(errno.ENOTDIR)
+        return self._dirents(path, offset)
+
+    def _stats_dirents(self, offset):
+        """readdir() for STATS_DIR."""
+        entries = [('.', None), ('..', None)]
+        uid, gid = self._requester()
+        for name in self.STATS_FILES:
+            st = self.tree.node_stat(self._stats_node(name))
+            st["st_uid"], st["st_gid"] = uid, gid
+            entries.append((name, st))
+        return [(name, st, n) for n, (name, st) in enumerate(entries, 1)][offset:]
+
+    def _dirents(self, path, offset):
+        """Generator behind readdir()."""
+        # Hand back each entry's attributes along with its name, so they
+        # don't each need a getattr() of their own.
+        uid, gid = self._requester()
+        if offset < 1:
+            yield '.', None, 1
+        if offset < 2:
+            yield '..', None, 2
+        start = max(offset, 2)
+        for n, (name, st) in enumerate(self.tree.items(path, with_stat=True,
+                start=start - 2), start + 1):
+            if st:
+                st["st_uid"], st["st_gid"] = uid, gid
+            yield name, st, n
+
+    def open(self, path, fi):
+        """Put a new file handle for the given path into fi."""
+        self._check_source()
+        name = self._stats_file(path)
+        if name is not None:
+            if not name:
+                raise fuse.FuseOSError(errno.EISDIR)
+            if name == "reset":
+                self.stats.reset(self.tree)
+            fi.fh = self.handles.open(self._stats_node(name))
+            fi.keep_cache = False
+            fi.direct_io = True
+            return 0
+        node = self._resolve(path)
+        if node.kind != Node.VALUE:
+            raise fuse.FuseOSError(errno.EISDIR)
+        fi.fh = self.handles.open(node)
+        # Pages the kernel already has for this file are still good if the
+        # hivefile is immutable, so don't make it throw them away on every
+        # open.  direct_io would skip the page cache entirely, so not that.
+        fi.keep_cache = self.immutable
+        fi.direct_io = False
+        return 0
 
     def read(self, path, size, offset, fh):
         """Return data at the given path, with given offset and size in bytes."""
+        # Binary data is read straight out of the hive, just the part that's
+        # asked for.  Otherwise, open files render their data once and read
+        # from that, and anything else (fuse shouldn't do this, but just in
+        # case) renders it again.
         # "Invariants" aside, fuse will happily pass a directory into read().
-        # But, bytestr won't allow it -- just catch that error and convert it
-        # to EISDIR if it happens.
-        try:
-            # I would have thought size and offset were essential for programs
-            # like head and tail to work properly, but actually it seems fine
-            # even if we just return all of the data and ignore those arguments.
-            # I don't know why...
-            data = self.tree.bytestr(path)
-            return data[offset:offset+size]
-        except ValueError:
-            raise fuse.FuseOSError(errno.EISDIR)
+        # Convert that to EISDIR if it happens.
+        fh = getattr(fh, "fh", fh)
+        name = self._stats_file(path)
+        if name is not None:
+            if not name:
+                raise fuse.FuseOSError(errno.EISDIR)
+            node = None
+            render = lambda node: self._stats_data(name)
+        else:
+            tree = self.tree # the same one throughout, even if it's reloaded
+            node = self._resolve(path, fh)
+            if node.kind != Node.VALUE:
+                raise fuse.FuseOSError(errno.EISDIR)
+            data = tree.node_read(node, offset, size)
+            if data is not None:
+                return data
+            render = tree.node_data
+            if self.stats is not None:
+                render = self._timed_render(tree)
+        if fh:
+            data = self.handles.buffer(fh, render)
+        else:
+            data = memoryview(render(node))
+        return data[offset:offset+size].tobytes()
+
+    def _timed_render(self, tree):
+        """Return tree.node_data, but counting its time in stats."""
+        def render(node):
+            start = _clock()
+            try:
+                return tree.node_data(node)
+            finally:
+                self.stats.add("tree.render", _clock() - start)
+        return render
+
+    def release(self, path, fh):
+        """Forget the given file handle and its data."""
+        self.handles.release(getattr(fh, "fh", fh))
+        return 0
 
     # FS Extended Attribute Methods
     # getxattr() and listattr() are all that are needed here.  Leaving out
-    # setxattr() works since fusepy's defaults do the trick.  These methods
-    # check for support first (or try, anyway) because overriding the defaults
-    # *without* support in the OS will cause "bad address" errors.
+    # setxattr() works since fusepy's defaults do the trick.  A missing
+    # attribute is ENOATTR where there is such a thing, and ENODATA (which
+    # is what it's called on Linux) otherwise.
 
     # Mapping of names <-> methods to call for reading extended attributes.
     # These little methods each take a RegistryValue and return a string,
@@ -550,41 +2940,94 @@ class WinRegFS(fuse.Operations):
     XATTRS["user.registry.datatype"] = get_value_str
     XATTRS["user.registry.text"]     = get_is_text
 
+    # The same again for keys, taking a RegistryKey.  These can return None
+    # for an attribute a key doesn't have.  All of them just read the key's
+    # own record, without going through its subkeys or values.
+
+    def get_subkeys(key):
+        """Return the number of subkeys the given RegistryKey has."""
+        return str(key.subkeys_number()).encode("ascii")
+
+    def get_values(key):
+        """Return the number of values the given RegistryKey has."""
+        return str(key.values_number()).encode("ascii")
+
+    def get_class(key):
+        """Return the class name of the given RegistryKey, or None if there isn't one."""
+        if not key._nkrecord.has_classname():
+            return None
+        return key._nkrecord.classname().encode("utf-8")
+
+    KEY_XATTRS = {}
+    KEY_XATTRS["user.registry.subkeys"] = get_subkeys
+    KEY_XATTRS["user.registry.values"]  = get_values
+    KEY_XATTRS["user.registry.class"]   = get_class
+
+    def _xattrs(self, node):
+        """Return the XATTRS-style mapping that applies to a Node."""
+        if node.kind == Node.VALUE:
+            return WinRegFS.XATTRS
+        if node.kind == Node.KEY:
+            return WinRegFS.KEY_XATTRS
+        return {}
+
     # TODO: what's position?
     def getxattr(self, path, name, position=0):
-        if hasattr(errno, "ENOATTR"):
-            """Return the requested attribute for the given path."""
-            try:
-                items = self.tree.items(path)
-            except ValueError:
-                val = self.tree.value(path)
-                try:
-                    return WinRegFS.XATTRS[name](val)
-                except KeyError:
-                    #return ""
-                    pass # raises exception below
-            raise fuse.FuseOSError(errno.ENOATTR)
-        else:
-            return super(self.__class__, self).getxattr(path, name, position)
+        """Return the requested attribute for the given path, as bytes."""
+        if self._stats_file(path) is not None:
+            raise fuse.FuseOSError(ENOATTR)
+        node = self._resolve(path)
+        xattrs = self._xattrs(node)
+        if name in xattrs:
+            attr = xattrs[name](self.tree.record(node))
+            if attr is not None:
+                # fuse copies this straight into a C buffer
+                if not isinstance(attr, bytes):
+                    attr = attr.encode("utf-8")
+                return attr
+        raise fuse.FuseOSError(ENOATTR)
 
     def listxattr(self, path):
         """Return a list of extended attributes available for the given path.
         
-        Currently there are no xattrs for directories, so an empty list is given
-        for those cases.  Files support a datatype attribute and a text (boolean
-        flag for non-binary data) attribute.
+        Files support a datatype attribute and a text (boolean flag for
+        non-binary data) attribute.  Keys have their numbers of subkeys and
+        values, and a class name if they have one.  Other directories (/ and
+        /hivekey) have none.
         
         """
-        # Key:   Fall through to returning an empty list
+        # Key:   Return the key xattrs that it has
         # Value: Return all supported xattrs
-        if hasattr(errno, "ENOATTR"):
-            try:
-                self.tree.items(path)
-            except ValueError:
-                return WinRegFS.XATTRS.keys()
+        if self._stats_file(path) is not None:
             return []
-        else:
-            return super(self.__class__, self).listxattr(path)
+        node = self._resolve(path)
+        if node.kind == Node.KEY:
+            key = self.tree.record(node)
+            return [name for name, get in WinRegFS.KEY_XATTRS.items()
+                    if get(key) is not None]
+        return list(self._xattrs(node).keys())
+
+
+class _FUSE(fuse.FUSE):
+    """fuse.FUSE, but with readdir() offsets passed through to WinRegFS.
+
+    fusepy's own readdir() always asks for a whole directory and drops the
+    offset fuse gives it, so a big directory would be listed from the start
+    again for every chunk the kernel reads.  This hands the offset along so
+    the listing can pick up where it left off, and stops as soon as fuse's
+    buffer is full.
+
+    """
+    def readdir(self, path, buf, filler, offset, fip):
+        for name, attrs, off in self.operations('readdir',
+                self._decode_optional_path(path), fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = fuse.c_stat()
+                fuse.set_st_attrs(st, attrs, use_ns=self.use_ns)
+            if filler(buf, name.encode(self.encoding), st, off) != 0:
+                break
+        return 0
 
 
 # All the command-line argument parsring code,
@@ -601,6 +3044,16 @@ mo_group = mo_parser.add_argument_group('Mount Options', 'Options affecting the
 mo_setup = {"type": str, "choices": ("yes", "no"), "default": "yes", "const": "yes", "nargs": "?"}
 mo_group.add_argument('-n', '--append-newline', help="append newlines to file data when appropriate (default: no)", **mo_setup)
 mo_group.add_argument('-e', '--append-extensions', help="append extensions to file names to match data types (default: yes).  Also available as an extended file attribute.", **mo_setup)
+mo_group.add_argument('--cache-size', type=int, metavar="N", help="number of resolved registry keys to keep cached (default: 4096)")
+mo_group.add_argument('--immutable', help="assume the hivefile won't change while mounted, and let the kernel cache everything (default: yes)", **mo_setup)
+mo_group.add_argument('--mmap', dest="use_mmap", help="map hivefiles into memory instead of reading them in (default: yes, unless --immutable=no)", **dict(mo_setup, default=None))
+mo_group.add_argument('--threads', type=int, metavar="N", help="most filesystem operations to handle at once; 1 runs fuse single-threaded (default: no limit)")
+mo_group.add_argument('--index', metavar="FILE", help="prebuilt index to use (see --build-index) (default: the hivefile's name plus .winregfs-index, if there is one)")
+mo_group.add_argument('--snapshot', help="read the whole hivefile in up front, into compact arrays, and answer lookups and listings from those (default: no)", **dict(mo_setup, default="no"))
+mo_group.add_argument('--prefetch', metavar="LIMITS", help="after mounting, walk the registry in the background to warm up caches, pausing whenever the filesystem is in use.  Either yes, or how far to go, as depth:N,mem:SIZE, where SIZE is how much the process's own memory may grow, not counting mapped hivefiles (default: no; with yes, the whole registry, up to 256M)")
+mo_group.add_argument('--stats', help="count and time filesystem operations, and show the results in /.winregfs/stats (default: no)", **dict(mo_setup, default="no"))
+mo_group.add_argument('--trace', metavar="FILE", help="write every filesystem operation to this file, for winregfs_bench.py --replay (default: none)")
+mo_group.add_argument('--buffer-size', type=int, metavar="MB", help="memory to use for the data of open files, in MiB (default: 64)")
 
 # A list of fuse options I know of that can only be specified with -o.
 # I've never actually found a definitive list anywhere; this just came from the
@@ -625,7 +3078,15 @@ class MountOptions(argparse.Action):
     # is done here for those, except that the options are recognized.
     def __call__(self, parser, namespace, values, option_string=None):
         args = []
+        options = []
         for option in values.split(','):
+            # Some settings have commas of their own, like
+            # prefetch=depth:4,mem:256M, so put those pieces back together.
+            if options and ':' in option and '=' not in option:
+                options[-1] += ',' + option
+            else:
+                options.append(option)
+        for option in options:
             key, val = option.partition('=')[::2]
             if key in FUSE_OPTIONS:
                 namespace.options = namespace.options or {}
@@ -639,19 +3100,265 @@ class MountOptions(argparse.Action):
 
 parser = argparse.ArgumentParser(parents=[mo_parser],
         description='Mount a Windows registry hivefile as a filesystem.')
-parser.add_argument('hivefile', help="hivefile to mount")
-parser.add_argument('mountpoint', help="path to filesystem mountpoint")
+parser.add_argument('hivefile', nargs='?', help="hivefile to mount")
+parser.add_argument('mountpoint', nargs='?', help="path to filesystem mountpoint (or with --export, the path within the registry to export, by default all of it)")
+parser.add_argument('--build-index', action="store_true",
+        help="instead of mounting, write an index of the whole hivefile for faster mounting later (to --index, or next to the hivefile)")
+parser.add_argument('--export', metavar="OUT",
+        help="instead of mounting, write everything that would be in the filesystem to this file (- for stdout), or with --batch, to files in this directory")
+parser.add_argument('--batch', metavar="LIST",
+        help="export each hivefile (or directory) listed in this file, one per line, instead of just one.  They're split up by hive and top-level key and exported by -j processes at once")
+parser.add_argument('--images', metavar="LIST",
+        help="mount every hivefile (or directory) listed in this file, one per line, each in its own directory under the mountpoint, all in one process (then the mountpoint is the only other argument)")
+parser.add_argument('-j', '--jobs', type=int, metavar="N",
+        help="processes to use for --batch (default: one per CPU)")
+parser.add_argument('--format', choices=("tar", "jsonl"),
+        help="format for --export: a tar archive, or JSON Lines with one key or value per line (default: jsonl if OUT ends in .jsonl, otherwise tar)")
 parser.add_argument('-f', '--foreground', action="store_true",
         help="run in foreground (default: False)",)
 parser.add_argument('-d', '--debug', action="store_true",
         help="show debugging output on stdout.  Implies -f. (default: False)")
 parser.add_argument('-o', '--options', metavar="opt,[opt...]", action=MountOptions, help="alternate syntax for mount options and generic FUSE options.  For example, -o append-newline=no,append-extensions=yes.  Any generic FUSE options given here will be passed directly to FUSE.")
 
+def _load_tree(hivefile, append_newline=None, append_extensions=None):
+    """Return a RegistryTree loaded with a hivefile, with the given settings."""
+    tree = RegistryTree()
+    try:
+        tree.load(os.path.abspath(hivefile))
+    except Exception:
+        raise ValueError('"' + hivefile + '"' +
+                " could not be loaded as a registry hivefile or directory")
+    if append_newline != None:
+        tree.append_newline = _yes(append_newline)
+    if append_extensions != None:
+        tree.append_extensions = _yes(append_extensions)
+    return tree
+
+def build_index(hivefile, index=None, append_newline=None,
+        append_extensions=None):
+    """Write an index for a hivefile (or directory) and return its filename."""
+    tree = _load_tree(hivefile, append_newline, append_extensions)
+    index = index or RegistryIndex.default_path(hivefile)
+    tree.write_index(index)
+    return index
+
+def export(hivefile, out, path=None, format=None, append_newline=None,
+        append_extensions=None):
+    """Export a path in a hivefile (or directory) to a file, or - for stdout.
+
+    See RegistryTree.export().  Returns the number of entries written.
+
+    """
+    tree = _load_tree(hivefile, append_newline, append_extensions)
+    path = "/" + (path or "").strip("/")
+    if format is None:
+        format = "jsonl" if out.endswith(".jsonl") else "tar"
+    try:
+        tree.resolve(path)
+    except ValueError:
+        raise ValueError('"' + path + '"' + " does not exist in the registry")
+    if out == "-":
+        return tree.export(getattr(sys.stdout, "buffer", sys.stdout), path, format)
+    with open(out, "wb") as f:
+        return tree.export(f, path, format)
+
+def _read_list(filename):
+    """Return the hivefiles (or directories) listed in a file, one per line."""
+    with open(filename) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith("#")]
+
+def _batch_shards(image, append_newline=None, append_extensions=None):
+    """Return (path, depth) pairs that cover all of an image between them.
+
+    These are what batch_export() hands out to its processes: each hive
+    root in multifile mode, otherwise each top-level key or value, plus the
+    directories above them on their own.  Hives whose files are missing are
+    still listed; _export_shard() gives them empty parts.
+
+    """
+    tree = _load_tree(image, append_newline, append_extensions)
+    shards = [("/", 0)]
+    for name in tree.items("/"):
+        path = "/" + name
+        if tree.multifile:
+            shards.append((path, 0))
+            shards.extend((path + "/" + sub, None) for sub in tree.items(path))
+        else:
+            shards.append((path, None))
+    return shards
+
+# The last tree _export_shard() loaded, by image and settings, so each process
+# only opens each image once.
+_shard_tree = (None, None)
+
+def _export_shard(task):
+    """Export one shard for batch_export() to a file; return (count, error)."""
+    global _shard_tree
+    image, path, depth, partfile, format, append_newline, append_extensions = task
+    key = (image, append_newline, append_extensions)
+    try:
+        if _shard_tree[0] != key:
+            _shard_tree = (None, None) # let go of the old one first
+            _shard_tree = (key, _load_tree(image, append_newline, append_extensions))
+        tree = _shard_tree[1]
+        with open(partfile, "wb") as f:
+            try:
+                tree.resolve(path)
+            except ValueError:
+                # A hive that isn't there (or won't load), which export()
+                # leaves out too; this shard is just empty.
+                return 0, None
+            count = tree.export(f, path, format, depth, finish=False)
+    except Exception as e:
+        # A corrupt hive can raise just about anything from deep in the
+        # parsing, and one bad image mustn't take the rest of the batch
+        # down with it.
+        return 0, str(e) or type(e).__name__
+    return count, None
+
+def batch_export(images, outdir, format=None, jobs=None, append_newline=None,
+        append_extensions=None):
+    """Export a list of hivefiles (or directories) into outdir, in parallel.
+
+    Each image is written to its own file in outdir, named after it plus
+    .tar or .jsonl.  (Images with the same name get -2, -3 and so on
+    added.)  The work is split into shards by hive and top-level key (see
+    _batch_shards()), and a pool of jobs processes (one per CPU by default)
+    exports those separately, each opening its images for itself.  The
+    pieces are put back together in order as they're done, so the files
+    come out exactly as export() would have written them.
+
+    Returns a list of (image, output filename, entries written, error) for
+    the images in order.  If anything in an image couldn't be exported,
+    error says why, and the output file is removed and given as None (with
+    0 entries).  Other images carry on regardless.
+
+    """
+    format = format or "tar"
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    partdir = tempfile.mkdtemp(prefix=".winregfs-batch", dir=outdir)
+    outputs = []
+    tasks = []
+    for i, (image, name) in enumerate(zip(images, _image_names(images))):
+        output = [image, os.path.join(outdir, name + "." + format), 0, None]
+        outputs.append(output)
+        try:
+            shards = _batch_shards(image, append_newline, append_extensions)
+        except Exception as e:
+            output[1:] = [None, 0, str(e) or type(e).__name__]
+            continue
+        for j, (path, depth) in enumerate(shards):
+            partfile = os.path.join(partdir, "%d-%d" % (i, j))
+            tasks.append((output, (image, path, depth, partfile, format,
+                    append_newline, append_extensions)))
+    pool = None
+    if jobs == 1:
+        results = (_export_shard(task) for output, task in tasks)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(_export_shard, [task for output, task in tasks])
+    current = None
+    f = None
+    finished = False
+    try:
+        for output, task in tasks:
+            count, error = next(results)
+            if output is not current:
+                if f is not None:
+                    _finish_batch_output(f, format)
+                current = output
+                f = open(output[1], "wb")
+            partfile = task[3]
+            if error is None:
+                with open(partfile, "rb") as part:
+                    shutil.copyfileobj(part, f)
+                output[2] += count
+            elif output[3] is None:
+                output[3] = task[1] + ": " + error
+            if os.path.exists(partfile):
+                os.remove(partfile)
+        if f is not None:
+            _finish_batch_output(f, format)
+        finished = True
+    finally:
+        if f is not None:
+            f.close()
+            if not finished:
+                os.remove(current[1]) # half-written
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(partdir)
+    for output in outputs:
+        if output[3] is not None and output[1] is not None:
+            os.remove(output[1])
+            output[1:3] = [None, 0]
+    return [tuple(output) for output in outputs]
+
+def _finish_batch_output(f, format):
+    if format == "tar":
+        f.write(_TAR_END)
+    f.close()
+
 def main(args):
-    settings = parser.parse_args(args[1:])
+    settings = vars(parser.parse_args(args[1:]))
+    out = settings.pop("export")
+    format = settings.pop("format")
+    batch = settings.pop("batch")
+    jobs = settings.pop("jobs")
+    if batch is not None:
+        if out is None:
+            parser.error("--batch needs an --export directory to write to")
+        try:
+            images = _read_list(batch)
+            results = batch_export(images, out, format, jobs,
+                    settings["append_newline"], settings["append_extensions"])
+        except (ValueError, EnvironmentError) as e:
+            print("Error: " + str(e))
+            return 1
+        status = 0
+        for image, outfile, count, error in results:
+            if error is not None:
+                print("Error: " + image + ": " + error)
+                status = 1
+        return status
+    images = settings.pop("images")
+    if images is not None:
+        if out is not None or settings["build_index"]:
+            parser.error("--images is only for mounting (see --batch for exporting)")
+        # The one positional argument there is, is the mountpoint.
+        if settings["mountpoint"] is None:
+            settings["mountpoint"] = settings["hivefile"]
+        try:
+            settings["hivefile"] = _read_list(images)
+        except EnvironmentError as e:
+            print("Error: " + str(e))
+            return 1
+    if settings["hivefile"] is None:
+        parser.error("a hivefile is required")
+    if out is not None:
+        try:
+            export(settings["hivefile"], out, settings["mountpoint"], format,
+                    settings["append_newline"], settings["append_extensions"])
+        except (ValueError, EnvironmentError) as e:
+            print("Error: " + str(e))
+            return 1
+        return 0
+    if settings.pop("build_index"):
+        try:
+            build_index(settings["hivefile"], settings["index"],
+                    settings["append_newline"], settings["append_extensions"])
+        except (ValueError, EnvironmentError) as e:
+            print("Error: " + str(e))
+            return 1
+        return 0
+    if settings["mountpoint"] is None:
+        parser.error("a mountpoint is required")
     regfs = WinRegFS()
     try:
-        regfs.setup(**vars(settings))
+        regfs.setup(**settings)
     except ValueError as e:
         print("Error: " + str(e))
         return 1
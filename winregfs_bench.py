@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+
+"""
+Benchmark RegistryTree and WinRegFS operations, without mounting anything.
+
+Basic command-line usage:
+    ./winregfs_bench.py                   run everything on generated hives
+    ./winregfs_bench.py --hivefile <file> run the general benchmarks on a real hive
+    ./winregfs_bench.py --json > before.json; ...; ./winregfs_bench.py --compare before.json
+    ./winregfs_bench.py --replay <tracefile> --hivefile <file>
+    ./winregfs_bench.py --shapes wide --wide 100,1000,10000,100000
+    ./winregfs_bench.py --help for more detailed information.
+
+Each benchmark calls one operation (RegistryTree.stat(), WinRegFS.getattr(),
+and so on) over and over on a freshly set-up filesystem, and reports
+operations per second and latency percentiles.  The WinRegFS methods are
+called directly, just as fuse would call them, so no FUSE installation or
+mountpoint permissions are needed.
+
+Unless a hivefile is given, the hives are written by winregfs_hivegen into a
+temporary directory, in a few shapes meant to show how things scale:
+
+    fan     a regular tree of keys, --fanout wide and 3 levels deep, with a
+            few values of each type in every key
+    wide    one key with --wide subkeys and as many values (with several
+            sizes given, one hive of each, compared side by side at the end)
+    deep    a chain of keys --depth levels deep
+    big     one binary value of --big-value bytes
+
+With --replay, the operations in a trace written by a mount with -o trace=FILE
+are played back instead, in order and as fast as they'll go, against a fresh
+WinRegFS for the given hivefile.  Then there's a benchmark for each kind of
+operation in the trace, plus "replay.all" for the whole thing.
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import itertools
+
+import winregfs_hivegen
+from winregfs import WinRegFS, Node, Tracer, fuse
+
+# perf_counter is the better clock, where there is one.
+clock = getattr(time, "perf_counter", time.time)
+
+READ_SIZE = 128 * 1024 # bytes per read() call, as the kernel would ask
+
+
+class FileInfo(object):
+    """Stand-in for the fuse_file_info struct open() fills in."""
+    fh = 0
+    keep_cache = False
+    direct_io = False
+
+
+class Benchmark(object):
+    """Latencies of one operation, and a summary of them."""
+
+    # Regular expression for the names of benchmarks to actually run
+    only = None
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.nbytes = 0 # Data handed back, for reads
+
+    def run(self, func, args, repeat=1):
+        """Call func(*a) for each a in args, repeat times over.
+
+        Does nothing if the name doesn't match only.
+
+        """
+        if self.only and not re.search(self.only, self.name):
+            return
+        times = self.times
+        for i in range(repeat):
+            for a in args:
+                start = clock()
+                result = func(*a)
+                times.append(clock() - start)
+                if isinstance(result, bytes):
+                    self.nbytes += len(result)
+
+    def summary(self):
+        """Return a dict of ops, ops/sec and latency percentiles (in us)."""
+        times = sorted(self.times)
+        total = sum(times)
+        pct = lambda p: times[min(len(times) - 1, int(len(times) * p))] * 1e6
+        summary = {"name": self.name, "ops": len(times),
+                "ops_per_sec": len(times) / total if total else 0.0,
+                "p50_us": pct(0.50), "p90_us": pct(0.90), "p99_us": pct(0.99),
+                "max_us": times[-1] * 1e6}
+        if self.nbytes:
+            summary["mb_per_sec"] = self.nbytes / total / 1e6 if total else 0.0
+        return summary
+
+
+def mounted(hivefile, scratch):
+    """Return a WinRegFS set up for hivefile, ready for its methods to be called."""
+    fs = WinRegFS()
+    fs.setup(hivefile, scratch, options={})
+    return fs
+
+
+def sample(items, count):
+    """Return up to count of items, spread evenly across them."""
+    items = list(items)
+    if len(items) <= count:
+        return items
+    step = len(items) / float(count)
+    return [items[int(i * step)] for i in range(count)]
+
+
+def read_whole(fs, path, size):
+    """Open, read all of (in READ_SIZE pieces) and release a file, like cat."""
+    fi = FileInfo()
+    fs.open(path, fi)
+    data = []
+    for offset in range(0, size, READ_SIZE):
+        data.append(fs.read(path, READ_SIZE, offset, fi))
+    fs.release(path, fi)
+    return b"".join(data)
+
+
+def general(prefix, hivefile, scratch, settings):
+    """Yield Benchmarks for the everyday operations on any hive.
+
+    These go over a sample of every key and value in the hive.
+
+    """
+    fs = mounted(hivefile, scratch)
+    walked = list(fs.tree.walk("/"))
+    keys = sample([(p,) for p, n in walked if n.kind != Node.VALUE], settings.sample)
+    values = sample([(p, n.size) for p, n in walked if n.kind == Node.VALUE], settings.sample)
+    everything = sample([(p,) for p, n in walked], settings.sample)
+    repeat = settings.repeat
+
+    bench = Benchmark(prefix + "tree.stat")
+    bench.run(mounted(hivefile, scratch).tree.stat, everything, repeat)
+    yield bench
+    bench = Benchmark(prefix + "tree.items")
+    tree = mounted(hivefile, scratch).tree
+    bench.run(lambda p: list(tree.items(p)), keys, repeat)
+    yield bench
+    bench = Benchmark(prefix + "tree.bytestr")
+    bench.run(mounted(hivefile, scratch).tree.bytestr,
+            [(p,) for p, size in values], repeat)
+    yield bench
+    bench = Benchmark(prefix + "fs.getattr")
+    bench.run(mounted(hivefile, scratch).getattr, everything, repeat)
+    yield bench
+    bench = Benchmark(prefix + "fs.readdir")
+    fs = mounted(hivefile, scratch)
+    bench.run(lambda p: list(fs.readdir(p, None)), keys, repeat)
+    yield bench
+    bench = Benchmark(prefix + "fs.read")
+    fs = mounted(hivefile, scratch)
+    bench.run(lambda p, size: read_whole(fs, p, size), values, repeat)
+    yield bench
+
+
+def wide(prefix, hivefile, scratch, settings):
+    """Yield Benchmarks for a key with a huge number of subkeys and values."""
+    fs = mounted(hivefile, scratch)
+    names = list(fs.tree.items("/Wide"))
+    paths = [("/Wide/" + name,) for name in sample(names, settings.sample)]
+    keys = [(p,) for p, in paths if fs.tree.resolve(p).kind != Node.VALUE]
+    repeat = settings.repeat
+
+    # Looking things up in a big key, by name
+    bench = Benchmark(prefix + "fs.getattr")
+    bench.run(mounted(hivefile, scratch).getattr, paths, repeat)
+    yield bench
+    # The same for subkeys, but with nothing kept about the paths or keys
+    # found, so every time it's down to the key's subkey list (or index)
+    bench = Benchmark(prefix + "tree.resolve-uncached")
+    tree = mounted(hivefile, scratch).tree
+    tree.paths.size = tree.key_cache.size = 0
+    bench.run(tree.resolve, keys, repeat)
+    yield bench
+    # Listing the whole thing, the way ls -l would
+    bench = Benchmark(prefix + "fs.readdir")
+    fs = mounted(hivefile, scratch)
+    bench.run(lambda p: list(fs.readdir(p, None)), [("/Wide",)], repeat)
+    yield bench
+    # Listing it from partway through, as fuse does when the kernel's
+    # buffer fills up
+    bench = Benchmark(prefix + "fs.readdir-resume")
+    fs = mounted(hivefile, scratch)
+    offsets = [("/Wide", None, n) for n in range(0, len(names), max(1, len(names) // 100))]
+    bench.run(lambda p, fh, n: next(iter(fs.readdir(p, fh, n)), None), offsets, repeat)
+    yield bench
+
+
+def deep(prefix, hivefile, scratch, settings):
+    """Yield Benchmarks for paths at every depth of a long chain of keys."""
+    fs = mounted(hivefile, scratch)
+    paths = [(p,) for p, n in fs.tree.walk("/") if n.kind != Node.VALUE]
+    repeat = settings.repeat * 100
+
+    bench = Benchmark(prefix + "fs.getattr")
+    bench.run(mounted(hivefile, scratch).getattr, paths, repeat)
+    yield bench
+    bench = Benchmark(prefix + "fs.getattr-deepest")
+    bench.run(mounted(hivefile, scratch).getattr, paths[-1:], repeat)
+    yield bench
+
+
+def big(prefix, hivefile, scratch, settings):
+    """Yield Benchmarks for reading one big binary value."""
+    fs = mounted(hivefile, scratch)
+    (path, node), = [(p, n) for p, n in fs.tree.walk("/") if n.kind == Node.VALUE]
+    repeat = settings.repeat
+
+    bench = Benchmark(prefix + "fs.read")
+    bench.run(lambda p, size: read_whole(fs, p, size), [(path, node.size)], repeat)
+    yield bench
+    # Just a small piece from the middle, like something seeking around in it
+    bench = Benchmark(prefix + "fs.read-piece")
+    middle = [(path, 4096, node.size // 2, None)]
+    bench.run(mounted(hivefile, scratch).read, middle, repeat * 100)
+    yield bench
+    bench = Benchmark(prefix + "tree.bytestr")
+    bench.run(mounted(hivefile, scratch).tree.bytestr, [(path,)], repeat)
+    yield bench
+
+
+def read_trace(tracefile):
+    """Yield a dict for each operation in a trace file written by Tracer."""
+    with open(tracefile) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = dict(zip(Tracer.FIELDS, line.rstrip("\n").split("\t")))
+            for field in ("path", "name"):
+                fields[field] = Tracer.unescape(fields[field])
+            for field in ("us", "size", "offset", "fh", "error"):
+                fields[field] = int(fields[field])
+            yield fields
+
+
+def replay(tracefile, hivefile, scratch, settings):
+    """Yield Benchmarks for the operations in a trace, played back in order.
+
+    The calls go through WinRegFS.__call__() just as they would from fuse.
+    File handles from the trace are matched up with the ones handed out here,
+    and readdir takes only as many entries as it did when traced.  Operations
+    that failed then are expected to fail now, with the same errno; any that
+    come out differently are counted up on stderr.
+
+    """
+    fs = mounted(hivefile, scratch)
+    benches = {}
+    handles = {} # traced file handle -> FileInfo
+    mismatched = 0
+    everything = Benchmark("replay.all")
+
+    def call(op, args, count):
+        try:
+            result = fs(op, *args)
+            if op == "readdir":
+                result = list(itertools.islice(result, count))
+            return result, 0
+        except fuse.FuseOSError as e:
+            return None, e.errno
+
+    for traced in read_trace(tracefile):
+        op, path, fh = traced["op"], traced["path"], traced["fh"]
+        if op == "read":
+            args = (path, traced["size"], traced["offset"], handles.get(fh))
+        elif op == "readdir":
+            args = (path, fh, traced["offset"])
+        elif op == "open":
+            args = (path, FileInfo())
+        elif op in ("getattr", "release"):
+            args = (path, handles.get(fh))
+        elif op == "getxattr":
+            args = (path, traced["name"])
+        elif op in ("listxattr", "readlink", "statfs", "opendir"):
+            args = (path,)
+        else:
+            # init, destroy and so on aren't worth timing
+            continue
+        bench = benches.get(op)
+        if bench is None:
+            bench = benches[op] = Benchmark("replay." + op)
+        start = clock()
+        result, error = call(op, args, traced["size"])
+        elapsed = clock() - start
+        bench.times.append(elapsed)
+        everything.times.append(elapsed)
+        if isinstance(result, bytes):
+            bench.nbytes += len(result)
+            everything.nbytes += len(result)
+        if error != traced["error"]:
+            mismatched += 1
+        if op == "open" and not error:
+            handles[fh] = args[1]
+        elif op == "release":
+            handles.pop(fh, None)
+    if mismatched:
+        sys.stderr.write("%d operations came out differently than traced\n" % mismatched)
+    for name in sorted(benches):
+        yield benches[name]
+    yield everything
+
+
+def wide_sizes(settings):
+    """Return the --wide sizes, as ints."""
+    return [int(n) for n in settings.wide.split(',')]
+
+
+def generated(scratch, settings):
+    """Write the generated hives into scratch and yield their Benchmarks."""
+    hives = [("fan", "fan", dict(fanout=settings.fanout, depth=3), general)]
+    sizes = wide_sizes(settings)
+    for size in sizes:
+        name = "wide" if len(sizes) == 1 else "wide%d" % size
+        hives.append(("wide", name, dict(depth=0, values=0, wide=size), wide))
+    hives += [
+        ("deep", "deep", dict(fanout=1, depth=settings.depth), deep),
+        ("big", "big", dict(depth=0, values=0, big_value=settings.big_value), big),
+        ]
+    for shape, name, kwargs, benchmarks in hives:
+        if shape not in settings.shapes.split(','):
+            continue
+        hivefile = os.path.join(scratch, name + ".dat")
+        winregfs_hivegen.generate(hivefile, **kwargs)
+        for bench in benchmarks(name + ".", hivefile, scratch, settings):
+            yield bench
+
+
+def compare(results, baseline, tolerance):
+    """Return the names of benchmarks more than tolerance slower than baseline."""
+    before = dict((b["name"], b) for b in baseline)
+    slower = []
+    for result in results:
+        old = before.get(result["name"])
+        if old and result["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            slower.append(result["name"])
+    return slower
+
+
+def sweep(results, sizes):
+    """Format the wide benchmarks for each size side by side, as p50 latencies.
+
+    If lookups really don't depend on how many subkeys there are, each row
+    should stay about flat.
+
+    """
+    p50 = dict((r["name"], r["p50_us"]) for r in results)
+    names = []
+    for r in results:
+        name = r["name"].split(".", 1)
+        if name[0] == "wide%d" % sizes[0] and name[1] not in names:
+            names.append(name[1])
+    lines = ["%-28s" % "p50 us by --wide" + "".join("%12d" % n for n in sizes)]
+    for name in names:
+        cells = [p50.get("wide%d.%s" % (n, name)) for n in sizes]
+        lines.append("%-28s" % ("wide." + name) +
+                "".join("%12s" % ("-" if c is None else "%.1f" % c) for c in cells))
+    return "\n".join(lines)
+
+
+def report(summary, baseline=None):
+    """Format a line of the results table."""
+    line = "%-28s %8d ops %10.0f ops/s  p50 %9.1f  p90 %9.1f  p99 %9.1f  max %10.1f us" % (
+            summary["name"], summary["ops"], summary["ops_per_sec"],
+            summary["p50_us"], summary["p90_us"], summary["p99_us"],
+            summary["max_us"])
+    if "mb_per_sec" in summary:
+        line += "  %8.1f MB/s" % summary["mb_per_sec"]
+    if baseline:
+        line += "  (%+.0f%%)" % ((summary["ops_per_sec"] / baseline["ops_per_sec"] - 1) * 100)
+    return line
+
+
+parser = argparse.ArgumentParser(
+        description='Benchmark winregfs operations without mounting anything.')
+parser.add_argument('--hivefile', help="benchmark this hivefile (or directory) instead of generated ones")
+parser.add_argument('--replay', metavar="TRACEFILE", help="play back a trace written with -o trace=FILE, against --hivefile")
+parser.add_argument('--shapes', default="fan,wide,deep,big", help="which generated hives to use (default: fan,wide,deep,big)")
+parser.add_argument('--only', metavar="REGEX", help="only run benchmarks with names matching this")
+parser.add_argument('--repeat', type=int, default=3, help="times to go over each benchmark's paths (default: 3)")
+parser.add_argument('--sample', type=int, default=1000, help="most paths to use per benchmark (default: 1000)")
+parser.add_argument('--fanout', type=int, default=10, help="subkeys per key in the generated fan hive (default: 10)")
+parser.add_argument('--wide', default="100000", help="subkeys (and values) in the generated wide key, or several sizes, comma-separated, to compare side by side (default: 100000)")
+parser.add_argument('--depth', type=int, default=10, help="levels in the generated deep chain of keys (default: 10)")
+parser.add_argument('--big-value', type=int, default=10 * 1024 * 1024, help="bytes in the generated big value (default: 10 MiB)")
+parser.add_argument('--json', action="store_true", help="print results as JSON instead of a table")
+parser.add_argument('--compare', metavar="FILE", help="compare against results saved from --json, and fail if anything got slower")
+parser.add_argument('--tolerance', type=float, default=0.2, help="how much slower counts as slower for --compare, as a fraction (default: 0.2)")
+
+def main(args):
+    settings = parser.parse_args(args[1:])
+    baseline = []
+    if settings.compare:
+        with open(settings.compare) as f:
+            baseline = json.load(f)
+    before = dict((b["name"], b) for b in baseline)
+    Benchmark.only = settings.only
+    scratch = tempfile.mkdtemp(prefix="winregfs_bench")
+    results = []
+    try:
+        if settings.replay:
+            if not settings.hivefile:
+                parser.error("--replay needs a --hivefile to play the trace against")
+            benchmarks = replay(settings.replay,
+                    os.path.abspath(settings.hivefile), scratch, settings)
+        elif settings.hivefile:
+            benchmarks = general("", os.path.abspath(settings.hivefile), scratch, settings)
+        else:
+            benchmarks = generated(scratch, settings)
+        for bench in benchmarks:
+            if not bench.times:
+                continue
+            summary = bench.summary()
+            results.append(summary)
+            if not settings.json:
+                print(report(summary, before.get(summary["name"])))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(scratch)
+    if settings.json:
+        print(json.dumps(results, indent=1, sort_keys=True))
+    elif not settings.hivefile and len(wide_sizes(settings)) > 1:
+        print("")
+        print(sweep(results, wide_sizes(settings)))
+    if settings.compare:
+        slower = compare(results, baseline, settings.tolerance)
+        if slower:
+            sys.stderr.write("Slower than before: " + ", ".join(slower) + "\n")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    status = main(sys.argv)
+    sys.exit(status)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+Write synthetic registry hive files for testing and benchmarking.
+
+Basic command-line usage:
+    ./winregfs_hivegen.py <hivefile> [--fanout N] [--depth N] [--values N]
+    ./winregfs_hivegen.py --help for more detailed information.
+
+The files written here are ordinary regf hives (base block, hbins, nk/vk
+records, lh/ri subkey lists and db big-data records), so anything that can
+read a real hive can read these too.  HiveWriter builds a tree in memory and
+lays it out in one go; generate() builds a tree of a given shape.
+
+"""
+
+import struct
+import argparse
+import sys
+
+# Value data types, as stored in the VK records.
+REG_NONE      = 0x0000
+REG_SZ        = 0x0001
+REG_EXPAND_SZ = 0x0002
+REG_BINARY    = 0x0003
+REG_DWORD     = 0x0004
+REG_MULTI_SZ  = 0x0007
+REG_QWORD     = 0x000B
+
+HBIN_SIZE    = 0x1000 # allocation unit for hbins
+HBIN_HEADER  = 0x20   # size of the header at the start of each hbin
+BIG_DATA_MAX = 0x3fd8 # largest chunk of value data stored in one cell
+LH_MAX       = 1024   # subkeys per lh list before switching to an ri list
+NONE         = 0xFFFFFFFF # "no such cell" offset
+
+# 2012-07-06 23:39:27 UTC as a FILETIME, just so everything has a timestamp.
+DEFAULT_TIMESTAMP = 129861915670000000
+
+
+def lh_hash(name):
+    """Return the lh subkey list hash for the given key name."""
+    h = 0
+    for c in name.upper():
+        h = (h * 37 + ord(c)) & 0xFFFFFFFF
+    return h
+
+
+def encode_name(name):
+    """Return (bytes, is_ascii) for a key or value name, as stored on disk."""
+    try:
+        return name.encode("ascii"), True
+    except UnicodeEncodeError:
+        return name.encode("utf-16le"), False
+
+
+def encode_data(datatype, data):
+    """Convert a python value into the raw bytes stored for a registry value."""
+    if datatype in (REG_SZ, REG_EXPAND_SZ):
+        return (data + u"\x00").encode("utf-16le")
+    if datatype == REG_MULTI_SZ:
+        return (u"\x00".join(data) + u"\x00\x00").encode("utf-16le")
+    if datatype == REG_DWORD:
+        return struct.pack("<I", data)
+    if datatype == REG_QWORD:
+        return struct.pack("<Q", data)
+    return bytes(data)
+
+
+class Key(object):
+    """A registry key waiting to be written."""
+
+    def __init__(self, name, timestamp=DEFAULT_TIMESTAMP, classname=None):
+        self.name = name
+        self.timestamp = timestamp
+        self.classname = classname
+        self.subkeys = []
+        self.values = [] # (name, datatype, raw bytes)
+        self.offset = None
+
+    def add_key(self, name, **kwargs):
+        """Add a subkey and return it."""
+        key = Key(name, **kwargs)
+        self.subkeys.append(key)
+        return key
+
+    def add_value(self, name, datatype, data):
+        """Add a value, converting the data to its on-disk form."""
+        self.values.append((name, datatype, encode_data(datatype, data)))
+
+
+class HiveWriter(object):
+    """Lay out a tree of Keys as a regf hive file.
+
+    1. Create a HiveWriter() object
+    2. Add keys and values under writer.root
+    3. Call write() with a filename
+
+    """
+    def __init__(self, hive_name=u"", timestamp=DEFAULT_TIMESTAMP):
+        self.hive_name = hive_name
+        self.timestamp = timestamp
+        self.root = Key(u"ROOT", timestamp=timestamp)
+        self._bins = bytearray()
+        self._free = 0 # relative offset of free space in the last hbin
+
+    def key(self, path, **kwargs):
+        """Return the key at a backslash-separated path, creating it if needed."""
+        key = self.root
+        for part in [p for p in path.split("\\") if p]:
+            for sub in key.subkeys:
+                if sub.name.lower() == part.lower():
+                    key = sub
+                    break
+            else:
+                key = key.add_key(part, **kwargs)
+        return key
+
+    # Cell allocation
+
+    def _alloc(self, size):
+        """Allocate a cell big enough for size bytes; return its relative offset."""
+        size = (size + 4 + 7) & ~7
+        end = len(self._bins)
+        if not end or self._free + size > end:
+            binsize = max(HBIN_SIZE, (size + HBIN_HEADER + HBIN_SIZE - 1) & ~(HBIN_SIZE - 1))
+            self._close_bin()
+            header = struct.pack("<4sIIQQI", b"hbin", end, binsize, 0,
+                    self.timestamp, 0)
+            self._bins += header + b"\x00" * (binsize - len(header))
+            self._free = end + HBIN_HEADER
+        offset = self._free
+        struct.pack_into("<i", self._bins, offset, -size)
+        self._free += size
+        return offset
+
+    def _close_bin(self):
+        """Mark the rest of the current hbin as one free cell."""
+        if self._bins and self._free < len(self._bins):
+            struct.pack_into("<i", self._bins, self._free, len(self._bins) - self._free)
+
+    def _cell(self, data):
+        """Allocate a cell holding data; return its relative offset."""
+        offset = self._alloc(len(data))
+        self._bins[offset + 4:offset + 4 + len(data)] = data
+        return offset
+
+    # Records
+
+    def _write_value(self, name, datatype, raw):
+        """Write a VK record (and its data cells); return the VK offset."""
+        namebytes, ascii = encode_name(name)
+        if len(raw) <= 4:
+            size = len(raw) | 0x80000000
+            dataoff = struct.unpack("<I", raw.ljust(4, b"\x00"))[0]
+        elif len(raw) <= BIG_DATA_MAX:
+            size = len(raw)
+            dataoff = self._cell(raw)
+        else:
+            size = len(raw)
+            segments = [self._cell(raw[i:i + BIG_DATA_MAX])
+                    for i in range(0, len(raw), BIG_DATA_MAX)]
+            seglist = self._cell(struct.pack("<%dI" % len(segments), *segments))
+            dataoff = self._cell(struct.pack("<2sHI", b"db", len(segments), seglist))
+        vk = struct.pack("<2sHIIIHH", b"vk", len(namebytes), size, dataoff,
+                datatype, 1 if ascii else 0, 0) + namebytes
+        return self._cell(vk)
+
+    def _write_subkey_list(self, key):
+        """Write the lh (or ri + lh) list for key's subkeys; return its offset."""
+        subkeys = sorted(key.subkeys, key=lambda k: k.name.upper())
+        lists = []
+        for i in range(0, len(subkeys), LH_MAX):
+            chunk = subkeys[i:i + LH_MAX]
+            entries = b"".join(struct.pack("<II", k.offset, lh_hash(k.name))
+                    for k in chunk)
+            lists.append(self._cell(struct.pack("<2sH", b"lh", len(chunk)) + entries))
+        if len(lists) == 1:
+            return lists[0]
+        return self._cell(struct.pack("<2sH%dI" % len(lists), b"ri", len(lists), *lists))
+
+    def _nk_size(self, key):
+        return 0x4C + len(encode_name(key.name)[0])
+
+    def _write_key(self, key, parent_offset, flags=0):
+        """Fill in the NK record for key (already allocated)."""
+        namebytes, ascii = encode_name(key.name)
+        if ascii:
+            flags |= 0x20
+        subkeys = NONE
+        if key.subkeys:
+            subkeys = self._write_subkey_list(key)
+        values = NONE
+        if key.values:
+            offsets = [self._write_value(*v) for v in key.values]
+            values = self._cell(struct.pack("<%dI" % len(offsets), *offsets))
+        classoff, classlen = NONE, 0
+        if key.classname:
+            classbytes = key.classname.encode("utf-16le")
+            classoff, classlen = self._cell(classbytes), len(classbytes)
+        max_subkey = max([len(k.name) * 2 for k in key.subkeys] or [0])
+        max_vname = max([len(v[0]) * 2 for v in key.values] or [0])
+        max_vdata = max([len(v[2]) for v in key.values] or [0])
+        nk = struct.pack("<2sHQIIIIIIIIIIIIIIIHH", b"nk", flags, key.timestamp,
+                0, parent_offset, len(key.subkeys), 0, subkeys, NONE,
+                len(key.values), values, NONE, classoff, max_subkey, classlen,
+                max_vname, max_vdata, 0, len(namebytes), classlen) + namebytes
+        self._bins[key.offset + 4:key.offset + 4 + len(nk)] = nk
+
+    def write(self, filename):
+        """Lay out the whole tree and write it to filename."""
+        self._bins = bytearray()
+        self._free = 0
+        # Allocate every NK record first so parents and children can refer to
+        # each other, then fill them in.
+        order = []
+        stack = [(self.root, None)]
+        while stack:
+            key, parent = stack.pop()
+            key.offset = self._alloc(self._nk_size(key))
+            order.append((key, parent))
+            stack.extend((k, key) for k in reversed(key.subkeys))
+        for key, parent in order:
+            if parent is None:
+                self._write_key(key, NONE, flags=0x2C)
+            else:
+                self._write_key(key, parent.offset)
+        self._close_bin()
+        with open(filename, "wb") as f:
+            f.write(self._base_block())
+            f.write(self._bins)
+
+    def _base_block(self):
+        """Return the 4096-byte regf header for the current layout."""
+        name = self.hive_name.encode("utf-16le")[:64].ljust(64, b"\x00")
+        header = bytearray(struct.pack("<4sIIQIIIIIII", b"regf", 1, 1,
+                self.timestamp, 1, 5, 0, 1, self.root.offset,
+                len(self._bins), 1) + name)
+        header += b"\x00" * (0x1FC - len(header))
+        checksum = 0
+        for i in range(0, 0x1FC, 4):
+            checksum ^= struct.unpack_from("<I", header, i)[0]
+        header += struct.pack("<I", checksum)
+        return bytes(header.ljust(HBIN_SIZE, b"\x00"))
+
+
+def generate(filename, fanout=10, depth=3, values=4, value_size=64,
+        wide=0, big_value=0):
+    """Write a hive with a regular shape and return the HiveWriter used.
+
+    The tree is depth levels deep with fanout subkeys per key ("Key0",
+    "Key1", ...).  Every key gets values of a few types, with binary values of
+    value_size bytes.  Optionally, a key "Wide" with wide subkeys and values
+    is added under the root, and a single RegBin value "Big" of big_value bytes
+    is added to the root.
+
+    """
+    writer = HiveWriter()
+    level = [writer.root]
+    for d in range(depth):
+        nextlevel = []
+        for key in level:
+            for i in range(fanout):
+                nextlevel.append(key.add_key(u"Key%d" % i))
+        level = nextlevel
+    # Add values to everything, walking the whole tree.
+    stack = [writer.root]
+    while stack:
+        key = stack.pop()
+        stack.extend(key.subkeys)
+        for i in range(values):
+            kind = i % 4
+            if kind == 0:
+                key.add_value(u"String%d" % i, REG_SZ, u"value %d of %s" % (i, key.name))
+            elif kind == 1:
+                key.add_value(u"Number%d" % i, REG_DWORD, i)
+            elif kind == 2:
+                key.add_value(u"Binary%d" % i, REG_BINARY, bytes(bytearray(j % 256 for j in range(value_size))))
+            else:
+                key.add_value(u"List%d" % i, REG_MULTI_SZ, [u"one", u"two", key.name])
+    if wide:
+        widekey = writer.root.add_key(u"Wide")
+        for i in range(wide):
+            widekey.add_key(u"Child%06d" % i)
+            widekey.add_value(u"Value%06d" % i, REG_DWORD, i)
+    if big_value:
+        writer.root.add_value(u"Big", REG_BINARY, bytes(bytearray(j % 251 for j in range(big_value))))
+    writer.write(filename)
+    return writer
+
+
+parser = argparse.ArgumentParser(
+        description='Write a synthetic Windows registry hivefile.')
+parser.add_argument('hivefile', help="hivefile to write")
+parser.add_argument('--fanout', type=int, default=10, help="subkeys per key (default: 10)")
+parser.add_argument('--depth', type=int, default=3, help="levels of subkeys (default: 3)")
+parser.add_argument('--values', type=int, default=4, help="values per key (default: 4)")
+parser.add_argument('--value-size', type=int, default=64, help="size of binary values in bytes (default: 64)")
+parser.add_argument('--wide', type=int, default=0, help="add a key with this many subkeys and values (default: 0)")
+parser.add_argument('--big-value', type=int, default=0, help="add a binary value of this many bytes (default: 0)")
+
+def main(args):
+    settings = parser.parse_args(args[1:])
+    generate(settings.hivefile, settings.fanout, settings.depth,
+            settings.values, settings.value_size, settings.wide,
+            settings.big_value)
+    return 0
+
+if __name__ == '__main__':
+    status = main(sys.argv)
+    sys.exit(status)
@@ -1,6 +1,19 @@
 #!/usr/bin/env python
-from winregfs import RegistryTree
+from winregfs import RegistryTree, Node, FileHandles, Prefetcher, OpStats, Tracer
+from winregfs import batch_export, RegistryForest, WinRegFS, ENOATTR
+import winregfs_hivegen
+import time
+import io
+import errno
+import json
+import base64
+import tarfile
 import os.path
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
 import unittest
 
 loc = lambda path: os.path.join(os.path.dirname(__file__), str(path))
@@ -25,19 +38,19 @@ class TestRegistryTree_Basic(unittest.TestCase):
 
         self.st_key = {}
         self.st_key["st_mode"]  = 0o40755 # drwxr-xr-x 
-        self.st_key["st_ino"]   = 0
+        self.st_key["st_ino"]   = None # filled in by test_stat
         self.st_key["st_dev"]   = 0
-        self.st_key["st_nlink"] = 2
+        self.st_key["st_nlink"] = None # filled in by test_stat
         self.st_key["st_uid"]   = 0
         self.st_key["st_gid"]   = 0
-        self.st_key["st_size"]  = 0
+        self.st_key["st_size"]  = None # filled in by test_stat
         self.st_key["st_atime"] = 0
         self.st_key["st_mtime"] = 1305848118 # Unix epoch time
         self.st_key["st_ctime"] = 0
 
         self.st_value = {}
         self.st_value["st_mode"]  = 0o100644 # -rw-r--r-- 
-        self.st_value["st_ino"]   = 0
+        self.st_value["st_ino"]   = None # filled in by test_stat
         self.st_value["st_dev"]   = 0
         self.st_value["st_nlink"] = 1
         self.st_value["st_uid"]   = 0
@@ -68,6 +81,251 @@ class TestRegistryTree_Basic(unittest.TestCase):
         key = self.tree.key(self.key_path)
         self.assertEqual(key.name(), self.key_name)
 
+    def test_key_cache(self):
+        self.tree.load(self.hivefile)
+        key = self.tree.key(self.key_path)
+        misses = self.tree.key_cache.misses
+        hits = self.tree.key_cache.hits
+        # The same key again (in any case) should come straight from the cache
+        self.assertIs(self.tree.key(self.key_path.upper()), key)
+        self.assertEqual(self.tree.key_cache.hits, hits + 1)
+        self.assertEqual(self.tree.key_cache.misses, misses)
+        # The cache should never grow past its size
+        self.tree.key_cache.size = 1
+        self.tree.key_cache.clear()
+        self.tree.key(self.key_path)
+        self.tree.stat(self.value_path)
+        self.assertEqual(len(self.tree.key_cache), 1)
+
+    def test_resolve(self):
+        # Haven't called load() yet
+        with self.assertRaises(ValueError):
+            self.tree.resolve(self.key_path)
+        self.tree.load(self.hivefile)
+        # Paths that don't exist
+        for path in (self.key_path_bad, self.value_path_bad,
+                self.value_path + "/not_a_key"):
+            with self.assertRaises(ValueError):
+                self.tree.resolve(path)
+        node = self.tree.resolve(self.key_path)
+        self.assertEqual(node.kind, Node.KEY)
+        self.assertEqual(self.tree.record(node).name(), self.key_name)
+        node = self.tree.resolve(self.value_path)
+        self.assertEqual(node.kind, Node.VALUE)
+        self.assertEqual(node.size, len(self.value_bytes))
+        self.assertEqual(self.tree.record(node).value(), self.value_value)
+        # Looking up another value in the same key uses the key's value index
+        hits = self.tree.value_names.hits
+        self.tree.resolve(self.value_path.upper())
+        self.assertEqual(self.tree.value_names.hits, hits + 1)
+
+    def test_missing(self):
+        self.tree.load(self.hivefile)
+        with self.assertRaises(ValueError):
+            self.tree.resolve(self.key_path_bad)
+        self.assertEqual(self.tree.missing.hits, 0)
+        # Asking again, or for something underneath, doesn't look again
+        for path in (self.key_path_bad, self.key_path_bad + "/more"):
+            with self.assertRaises(ValueError):
+                self.tree.resolve(path)
+        self.assertEqual(self.tree.missing.hits, 2)
+        self.tree.resolve(self.key_path)
+        self.tree.load(self.hivefile)
+        self.assertEqual(len(self.tree.missing), 0)
+
+    def test_inodes(self):
+        self.tree.load(self.hivefile)
+        key = self.tree.resolve(self.key_path)
+        value = self.tree.resolve(self.value_path)
+        self.assertNotEqual(key.inode, value.inode)
+        self.assertNotEqual(key.inode, self.tree.resolve("/").inode)
+        # Nodes can be found again by inode, without going through resolve()
+        self.assertEqual(len(self.tree.inodes), 0)
+        for node in (key, value):
+            found = self.tree.node(node.inode)
+            self.assertEqual((found.kind, found.offset, found.size),
+                    (node.kind, node.offset, node.size))
+        with self.assertRaises(ValueError):
+            self.tree.node(12345)
+
+    def test_changed(self):
+        # Work on a copy, so the copy can be "changed"
+        tmp = tempfile.mkdtemp()
+        try:
+            hivefile = os.path.join(tmp, "hive")
+            if os.path.isdir(self.hivefile):
+                shutil.copytree(self.hivefile, hivefile)
+            else:
+                shutil.copy(self.hivefile, hivefile)
+            self.tree.load(hivefile)
+            self.assertFalse(self.tree.changed())
+            for dirpath, dirnames, filenames in os.walk(tmp):
+                for filename in filenames:
+                    os.utime(os.path.join(dirpath, filename), (0, 0))
+            self.assertTrue(self.tree.changed())
+            self.tree.reload()
+            self.assertFalse(self.tree.changed())
+            self.tree.key(self.key_path)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_index(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            index = os.path.join(tmp, "index")
+            self.tree.load(self.hivefile)
+            self.tree.write_index(index)
+            indexed = RegistryTree()
+            indexed.append_extensions = self.tree.append_extensions
+            indexed.append_newline = self.tree.append_newline
+            indexed.load(self.hivefile)
+            indexed.use_index(index)
+            # Everything looks the same with or without it
+            for path in (self.key_path, self.value_path, "/"):
+                self.assertEqual(indexed.stat(path), self.tree.stat(path))
+            for path in (self.key_path, "/"):
+                self.assertEqual(list(indexed.items(path, with_stat=True)),
+                        list(self.tree.items(path, with_stat=True)))
+                self.assertEqual(list(indexed.items(path, start=1)),
+                        list(self.tree.items(path, start=1)))
+            self.assertEqual(indexed.bytestr(self.value_path), self.value_bytes)
+            with self.assertRaises(ValueError):
+                indexed.stat(self.key_path_bad)
+            with self.assertRaises(ValueError):
+                indexed.items(self.value_path)
+            # An index only goes with the settings it was built with
+            other = RegistryTree()
+            other.append_extensions = not self.tree.append_extensions
+            other.append_newline = self.tree.append_newline
+            other.load(self.hivefile)
+            with self.assertRaises(ValueError):
+                other.use_index(index)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_snapshot(self):
+        self.tree.load(self.hivefile)
+        snapped = RegistryTree()
+        snapped.append_extensions = self.tree.append_extensions
+        snapped.append_newline = self.tree.append_newline
+        snapped.load(self.hivefile)
+        snapshot = snapped.take_snapshot()
+        # Everything looks the same with or without it
+        for path in (self.key_path, self.value_path, "/"):
+            self.assertEqual(snapped.stat(path), self.tree.stat(path))
+        for path in (self.key_path, "/"):
+            self.assertEqual(list(snapped.items(path, with_stat=True)),
+                    list(self.tree.items(path, with_stat=True)))
+            self.assertEqual(list(snapped.items(path, start=1)),
+                    list(self.tree.items(path, start=1)))
+        self.assertEqual(snapped.bytestr(self.value_path), self.value_bytes)
+        with self.assertRaises(ValueError):
+            snapped.stat(self.key_path_bad)
+        # The columns describe the values too
+        row = snapshot.find(self.value_path)
+        self.assertEqual(snapshot.find(snapshot.path(row)), row)
+        self.assertEqual(snapshot.value_type[row],
+                self.tree.value(self.value_path)._vkrecord.data_type())
+
+    def test_mmap(self):
+        self.tree.use_mmap = False
+        self.tree.load(self.hivefile)
+        read_items = sorted(self.tree.items(self.key_path))
+        self.assertNotIsInstance(self.tree._regs[0][0]._buf, mmap.mmap)
+        self.tree.use_mmap = True
+        self.tree.load(self.hivefile)
+        self.assertEqual(sorted(self.tree.items(self.key_path)), read_items)
+        self.assertIsInstance(self.tree._regs[0][0]._buf, mmap.mmap)
+        self.assertEqual(self.tree.bytestr(self.value_path), self.value_bytes)
+
+    def test_value_sizes(self):
+        self.tree.load(self.hivefile)
+        # Worked out without rendering where possible, but always the same
+        for path in (self.key_path, self.value_path.rsplit("/", 1)[0], "/"):
+            for name, st in self.tree.items(path, with_stat=True):
+                node = self.tree.resolve(path.rstrip("/") + "/" + name)
+                if node.kind == Node.VALUE:
+                    self.assertEqual(st["st_size"], len(self.tree.node_data(node)))
+
+    def test_node_read(self):
+        self.tree.load(self.hivefile)
+        for path in (self.key_path, self.value_path.rsplit("/", 1)[0], "/"):
+            for name in self.tree.items(path):
+                node = self.tree.resolve(path.rstrip("/") + "/" + name)
+                if node.kind != Node.VALUE:
+                    continue
+                data = self.tree.node_data(node)
+                for offset, size in ((0, 64), (1, 3), (len(data) - 1, 10), (len(data) + 5, 1)):
+                    part = self.tree.node_read(node, offset, size)
+                    # None means it has to be rendered, and that's only for non-binary types
+                    if part is None:
+                        self.assertNotIn(self.tree.record(node).value_type_str(), ("RegBin", "RegNone"))
+                    else:
+                        self.assertEqual(part, data[offset:offset + size])
+
+    def test_threads(self):
+        self.tree.load(self.hivefile)
+        # Every path we can find near the test key, and what it should be,
+        # worked out in one thread first.
+        expected = {}
+        for path in (self.key_path, self.value_path.rsplit("/", 1)[0], "/"):
+            for name in self.tree.items(path):
+                full = path.rstrip("/") + "/" + name
+                try:
+                    node = self.tree.resolve(full)
+                except ValueError:
+                    continue # a hive that isn't there
+                if node.kind == Node.VALUE:
+                    expected[full] = (self.tree.stat(full), self.tree.node_data(node))
+                else:
+                    expected[full] = (self.tree.stat(full), sorted(self.tree.items(full)))
+        # Then hammer it from a bunch of threads at once with a fresh tree
+        # and tiny caches, so everything's being evicted all the time too.
+        tree = RegistryTree()
+        tree.append_extensions = self.tree.append_extensions
+        tree.append_newline = self.tree.append_newline
+        for cache in (tree.key_cache, tree.value_names, tree.inodes, tree.value_sizes):
+            cache.size = 2
+        tree.load(self.hivefile)
+        # Listings go through WinRegFS too, with a limit on how many
+        # operations run at once.
+        fs = WinRegFS()
+        fs.tree = tree
+        fs._slots = threading.BoundedSemaphore(2)
+        errors = []
+        def hammer():
+            try:
+                for i in range(20):
+                    for path in expected:
+                        node = tree.resolve(path)
+                        if node.kind == Node.VALUE:
+                            got = (tree.stat(path), tree.node_data(node))
+                        else:
+                            got = (tree.stat(path), sorted(tree.items(path)))
+                            names = [e[0] for e in fs("readdir", path, 0, 0)]
+                            if sorted(names[2:]) != got[1]:
+                                errors.append((path, names))
+                        if got != expected[path]:
+                            errors.append((path, got))
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=hammer) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        # A listing holds its slot until it's been read through, and every
+        # slot's been given back.
+        listing = fs("readdir", "/", 0, 0)
+        next(listing)
+        self.assertTrue(fs._slots.acquire(False))
+        self.assertFalse(fs._slots.acquire(False))
+        fs._slots.release()
+        list(listing)
+        self.assertTrue(fs._slots.acquire(False))
+        self.assertTrue(fs._slots.acquire(False))
+
     def test_value(self):
         # Haven't called load() yet
         with self.assertRaises(ValueError):
@@ -96,9 +354,34 @@ class TestRegistryTree_Basic(unittest.TestCase):
         for path in (self.value_path, self.value_path_bad):
             with self.assertRaises(ValueError):
                 self.tree.items(path)
-        items = self.tree.items(self.key_path)
+        items = list(self.tree.items(self.key_path))
         # TODO: check list of items
+        # Listings can start partway through
+        for start in range(len(items) + 2):
+            self.assertEqual(list(self.tree.items(self.key_path, start=start)),
+                    items[start:])
+
+    def test_items_with_stat(self):
+        self.tree.load(self.hivefile)
+        for path in (self.key_path, "/"):
+            items = list(self.tree.items(path, with_stat=True))
+            self.assertEqual([name for name, st in items], list(self.tree.items(path)))
+            # Same as stat()ing each one separately
+            for name, st in items:
+                self.assertEqual(st, self.tree.stat(path.rstrip("/") + "/" + name))
     
+    def test_walk(self):
+        self.tree.load(self.hivefile)
+        walked = list(self.tree.walk("/", depth=1))
+        self.assertEqual(walked[0][0], "/")
+        self.assertEqual([path for path, node in walked[1:]],
+                ["/" + name for name in self.tree.items("/")])
+        # Everything under a key, and only that
+        paths = [path for path, node in self.tree.walk(self.key_path)]
+        self.assertIn(self.value_path, paths)
+        for path in paths:
+            self.assertTrue(path.startswith(self.key_path.rstrip("/")))
+
     def test_bytestr(self):
         self.tree.load(self.hivefile)
         data = self.tree.bytestr(self.value_path)
@@ -115,6 +398,16 @@ class TestRegistryTree_Basic(unittest.TestCase):
             self.tree.stat(self.key_path_bad)
         with self.assertRaises(ValueError):
             self.tree.stat(self.value_path_bad)
+        # Inode numbers should be the same for any load of the same file.
+        other = RegistryTree()
+        other.append_extensions = self.tree.append_extensions
+        other.load(self.hivefile)
+        self.st_key["st_ino"] = other.resolve(self.key_path).inode
+        self.st_value["st_ino"] = other.resolve(self.value_path).inode
+        # Keys count their subkeys and values
+        key = other.key(self.key_path)
+        self.st_key["st_nlink"] = 2 + len(key.subkeys())
+        self.st_key["st_size"] = len(key.subkeys()) + len(key.values())
         # Test an actual key that should work
         st_key = self.tree.stat(self.key_path)
         self.assertEqual(st_key, self.st_key)
@@ -203,6 +496,14 @@ class TestRegistryTree_Combined(TestRegistryTree_Basic):
         key = self.tree.key(self.key_path)
         self.assertEqual(key.name(), self.key_name)
 
+    def test_lazy_load(self):
+        self.tree.load(self.hivefile)
+        # Nothing's actually read until it's used
+        self.assertEqual(self.tree._regs.count(None), len(self.tree._regs))
+        self.assertIn("SYSTEM", self.tree.items(self.key_path_hive))
+        self.tree.stat(self.key_path)
+        self.assertEqual(self.tree._regs.count(None), len(self.tree._regs) - 1)
+
 
 class TestRegistryTree_Windir(TestRegistryTree_Combined):
     """Test with loading multiple hivefiles from a whole Windows directory."""
@@ -212,6 +513,504 @@ class TestRegistryTree_Windir(TestRegistryTree_Combined):
         self.hivefile = REG_EXAMPLE_WINDIR
 
 
+class TestRegistryTree_Generated(unittest.TestCase):
+    """Test RegistryTree against hives from winregfs_hivegen."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.hivefile = os.path.join(self.tmp, "hive.dat")
+        winregfs_hivegen.generate(self.hivefile, fanout=3, depth=2, values=4,
+                wide=2000, big_value=100000)
+        self.tree = RegistryTree()
+        self.tree.load(self.hivefile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_prefetch(self):
+        # The tree's bigger than its caches here, so the walk stops before
+        # it'd push out the shallow paths it put in first.
+        self.tree.paths.size = 100
+        prefetcher = Prefetcher()
+        prefetcher.start(self.tree)
+        prefetcher.join()
+        self.assertEqual(prefetcher.visited, 100)
+        for path in ("/Key0", "/Key2", "/Key0/Key0"):
+            self.assertIn(self.tree._path_key(path), self.tree.paths)
+
+    def test_shape(self):
+        # 3 + 9 keys, plus Wide, plus / itself; 4 values in each of those but
+        # Wide, plus Big and Wide's own values and subkeys
+        paths = dict(self.tree.walk("/"))
+        self.assertEqual(len(paths), 1 + 12 + 1 + 13 * 4 + 1 + 2 * 2000)
+        self.assertEqual(self.tree.bytestr("/Key2/Key1/String0.RegSZ"),
+                "value 0 of Key1\n")
+        self.assertEqual(self.tree.bytestr("/Key0/Number1.RegDWord"), "1\n")
+        # Everything in a big key can be found, looked up from scratch
+        # rather than from what the walk left in the caches
+        for name in self.tree.CACHES:
+            getattr(self.tree, name).clear()
+        for i in range(0, 2000, 37):
+            self.tree.resolve("/Wide/Child%06d" % i)
+            self.tree.resolve("/Wide/Value%06d.RegDWord" % i)
+        self.assertEqual(len(self.tree.subkey_names), 1)
+
+    def test_subkey_lookup(self):
+        # Both ways _subkey() finds a key: a name index for keys with at
+        # least SUBKEY_INDEX_MIN subkeys, and the lh hashes otherwise (which
+        # non-ASCII names can't use).
+        hivefile = os.path.join(self.tmp, "lookup.dat")
+        many = RegistryTree.SUBKEY_INDEX_MIN + 1
+        writer = winregfs_hivegen.HiveWriter()
+        for i in range(many):
+            writer.key(u"Many").add_key(u"Sub%d" % i)
+        for name in (u"Plain", u"\u00dcn\u00efcode", u"Other"):
+            writer.key(u"Small").add_key(name)
+        writer.write(hivefile)
+        tree = RegistryTree()
+        tree.load(hivefile)
+        for i in range(many):
+            tree.resolve("/Many/Sub%d" % i)
+        self.assertEqual(len(tree.subkey_names), 1)
+        tree.resolve(u"/Small/\u00dcn\u00efcode")
+        tree.resolve(u"/Small/\u00fcN\u00cfCODE")
+        tree.resolve("/Small/pLAIN")
+        self.assertEqual(len(tree.subkey_names), 1)
+        for path in ("/Many/Sub%d" % many, "/Small/Plainer", u"/Small/\u00dcn"):
+            self.assertRaises(ValueError, tree.resolve, path)
+
+    def test_big_value(self):
+        node = self.tree.resolve("/Big.RegBin")
+        self.assertEqual(node.size, 100000)
+        data = self.tree.node_data(node)
+        self.assertEqual(data, bytes(bytearray(j % 251 for j in range(100000))))
+        for offset in (0, 16343, 16344, 99999):
+            self.assertEqual(self.tree.node_read(node, offset, 5000),
+                    data[offset:offset + 5000])
+
+    def test_walk_depth_first(self):
+        walked = [path for path, node in self.tree.walk("/", depth_first=True)]
+        self.assertEqual(sorted(walked), sorted(dict(self.tree.walk("/"))))
+        # Everything under a key comes right after it
+        start = walked.index("/Key1")
+        self.assertEqual(walked[start + 1:start + 5],
+                ["/Key1/Key0", "/Key1/Key0/String0.RegSZ",
+                "/Key1/Key0/Number1.RegDWord", "/Key1/Key0/Binary2.RegBin"])
+        self.assertEqual(len([p for p, n in self.tree.walk("/Key1", 1, True)]), 1 + 3 + 4)
+
+    def test_export(self):
+        out = io.BytesIO()
+        count = self.tree.export(out, "/Key1")
+        out.seek(0)
+        archive = tarfile.open(fileobj=out)
+        members = dict((m.name, m) for m in archive)
+        self.assertEqual(count, len(members))
+        self.assertEqual(len(members), 1 + 3 + 4 * 4)
+        self.assertTrue(members["Key1/Key2"].isdir())
+        member = members["Key1/Key2/String0.RegSZ"]
+        self.assertEqual(archive.extractfile(member).read(), b"value 0 of Key2\n")
+        # Big values are copied out a piece at a time
+        out = io.BytesIO()
+        self.tree.export(out, "/Big.RegBin")
+        out.seek(0)
+        archive = tarfile.open(fileobj=out)
+        self.assertEqual(archive.extractfile("Big.RegBin").read(),
+                self.tree.node_data(self.tree.resolve("/Big.RegBin")))
+
+    def test_batch_export(self):
+        other = os.path.join(self.tmp, "other.dat")
+        winregfs_hivegen.generate(other, fanout=2, depth=3)
+        outdir = os.path.join(self.tmp, "out")
+        images = [self.hivefile, other, "/does/not/exist.dat", other]
+        results = batch_export(images, outdir, jobs=2)
+        self.assertEqual([r[1] and os.path.basename(r[1]) for r in results],
+                ["hive.dat.tar", "other.dat.tar", None, "other.dat-2.tar"])
+        self.assertIsNotNone(results[2][3])
+        # Put back together, each is just what export() writes
+        for image, outfile, count, error in results:
+            if outfile is None:
+                continue
+            tree = RegistryTree()
+            tree.load(image)
+            out = io.BytesIO()
+            self.assertEqual(count, tree.export(out))
+            with open(outfile, "rb") as f:
+                self.assertEqual(f.read(), out.getvalue())
+        self.assertEqual(sorted(os.listdir(outdir)),
+                ["hive.dat.tar", "other.dat-2.tar", "other.dat.tar"])
+
+    def test_batch_export_corrupt(self):
+        # Point one key's subkey list off the end of the file, in a copy
+        # between two good ones; only that image fails.
+        bad = os.path.join(self.tmp, "bad.dat")
+        offset = self.tree.resolve("/Key1").offset
+        with open(self.hivefile, "rb") as f:
+            data = bytearray(f.read())
+        struct.pack_into("<I", data, offset + 0x1C, 0x7ffffff0)
+        with open(bad, "wb") as f:
+            f.write(bytes(data))
+        outdir = os.path.join(self.tmp, "out")
+        results = batch_export([self.hivefile, bad, self.hivefile], outdir, jobs=1)
+        self.assertEqual([r[1] and os.path.basename(r[1]) for r in results],
+                ["hive.dat.tar", None, "hive.dat-2.tar"])
+        self.assertIn("/Key1", results[1][3])
+        self.assertEqual(results[1][2], 0)
+        self.assertEqual(sorted(os.listdir(outdir)), ["hive.dat-2.tar", "hive.dat.tar"])
+
+    def test_batch_export_dir(self):
+        # A directory with only some of its hives, the way they're often
+        # found; the missing ones are left out, as export() does.
+        configdir = os.path.join(self.tmp, "config")
+        os.mkdir(configdir)
+        shutil.copy(self.hivefile, os.path.join(configdir, "system"))
+        winregfs_hivegen.generate(os.path.join(configdir, "software"),
+                fanout=2, depth=2)
+        outdir = os.path.join(self.tmp, "out")
+        (image, outfile, count, error), = batch_export([configdir], outdir, jobs=2)
+        self.assertIsNone(error)
+        tree = RegistryTree()
+        tree.load(configdir)
+        out = io.BytesIO()
+        self.assertEqual(count, tree.export(out))
+        with open(outfile, "rb") as f:
+            self.assertEqual(f.read(), out.getvalue())
+
+    def test_lazy_load_errors(self):
+        # A hive's file is only read when it's first needed, and what goes
+        # wrong then is told apart: not a hive, or not readable at all.
+        configdir = os.path.join(self.tmp, "config")
+        os.mkdir(configdir)
+        for name in ("system", "software", "SAM"):
+            shutil.copy(self.hivefile, os.path.join(configdir, name))
+        tree = RegistryTree()
+        tree.load(configdir)
+        with open(os.path.join(configdir, "software"), "r+b") as f:
+            f.truncate(0x1000)
+        os.remove(os.path.join(configdir, "SAM"))
+        os.mkdir(os.path.join(configdir, "SAM"))
+        self.assertRaises(ValueError, tree.resolve, "/HKLM/SOFTWARE/Key0")
+        with self.assertRaises(EnvironmentError) as e:
+            tree.resolve("/HKLM/SAM/Key0")
+        self.assertEqual(e.exception.errno, errno.EISDIR)
+        tree.resolve("/HKLM/SYSTEM/Key0")
+
+    def test_export_jsonl(self):
+        out = io.BytesIO()
+        self.tree.export(out, "/Key1/Key2", "jsonl")
+        records = [json.loads(line.decode("utf-8")) for line in out.getvalue().splitlines()]
+        self.assertEqual(records[0]["path"], "/Key1/Key2")
+        self.assertEqual(records[0]["kind"], "key")
+        values = dict((r["path"].split("/")[-1], r) for r in records[1:])
+        self.assertEqual(values["String0.RegSZ"]["data"], "value 0 of Key2\n")
+        self.assertEqual(values["Number1.RegDWord"]["type"], "RegDWord")
+        # Binary data that happens to be valid UTF-8 still comes out as text
+        self.assertEqual(values["Binary2.RegBin"]["data"], u"".join(map(chr, range(64))))
+        out = io.BytesIO()
+        self.tree.export(out, "/Big.RegBin", "jsonl")
+        record = json.loads(out.getvalue().decode("utf-8"))
+        self.assertEqual(base64.b64decode(record["data_base64"]),
+                bytes(bytearray(j % 251 for j in range(100000))))
+
+
+class TestRegistryForest(unittest.TestCase):
+    """Test RegistryForest with a few generated hives, two of them the same."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.images = [os.path.join(self.tmp, name) for name in ("a.dat", "b.dat")]
+        winregfs_hivegen.generate(self.images[0], fanout=3, depth=2)
+        winregfs_hivegen.generate(self.images[1], fanout=2, depth=3)
+        os.mkdir(os.path.join(self.tmp, "copy"))
+        self.images.append(os.path.join(self.tmp, "copy", "a.dat"))
+        shutil.copy(self.images[0], self.images[2])
+        self.forest = RegistryForest()
+        self.forest.load(self.images)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_layout(self):
+        self.assertEqual(list(self.forest.items("/")), ["a.dat", "b.dat", "a.dat-2"])
+        # Each image's directory has just what the image has on its own
+        seen = set()
+        for name, image in zip(self.forest.trees, self.images):
+            tree = RegistryTree()
+            tree.load(image)
+            for path, node in tree.walk("/"):
+                found = self.forest.resolve("/" + name + path)
+                self.assertEqual(self.forest.node_stat(found)["st_size"], node.size)
+                if node.kind == Node.VALUE:
+                    self.assertEqual(self.forest.node_data(found), tree.node_data(node))
+                # ... but with inode numbers of its own
+                self.assertNotIn(found.inode, seen)
+                seen.add(found.inode)
+                self.assertEqual(self.forest.node(found.inode).offset, found.offset)
+        self.assertEqual(self.forest.bytestr("/a.dat-2/Key0/Number1.RegDWord"), "1\n")
+        self.assertRaises(ValueError, self.forest.resolve, "/c.dat")
+
+    def test_sharing(self):
+        list(self.forest.walk("/"))
+        # The copy is only opened once, and the caches are all the same ones
+        self.assertEqual(self.forest.registries.opened, 2)
+        self.assertEqual(self.forest.registries.shared, 1)
+        self.assertIs(self.forest.trees["a.dat"].hivefile,
+                self.forest.trees["a.dat-2"].hivefile)
+        for tree in self.forest.trees.values():
+            self.assertIs(tree.key_cache, self.forest.key_cache)
+        # A copy's found by its contents, without opening it at all
+        registries = type(self.forest.registries)()
+        opened = []
+        def opener(path):
+            opened.append(path)
+            return RegistryTree()._open_registry(path)
+        for image in self.images:
+            registries.open(image, opener)
+        self.assertEqual(opened, self.images[:2])
+        # Settings apply to every image
+        self.forest.append_extensions = False
+        self.forest.resolve("/b.dat/Key1/String0")
+        self.forest.resolve("/a.dat-2/String0")
+
+
+class TestWinRegFS_Xattrs(unittest.TestCase):
+    """Test WinRegFS's extended attributes, on a generated hive."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        hivefile = os.path.join(self.tmp, "hive.dat")
+        writer = winregfs_hivegen.HiveWriter()
+        writer.key(u"Plain").add_key(u"Sub")
+        writer.key(u"Classy", classname=u"MyClass")
+        writer.key(u"Plain").add_value(u"Text", winregfs_hivegen.REG_SZ, u"hello")
+        writer.write(hivefile)
+        self.fs = WinRegFS()
+        self.fs.setup(hivefile, self.tmp, options={})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_key(self):
+        self.assertEqual(sorted(self.fs.listxattr("/Plain")),
+                ["user.registry.subkeys", "user.registry.values"])
+        self.assertEqual(self.fs.getxattr("/Plain", "user.registry.subkeys"), b"1")
+        self.assertEqual(self.fs.getxattr("/Plain", "user.registry.values"), b"1")
+        with self.assertRaises(OSError) as e:
+            self.fs.getxattr("/Plain", "user.registry.class")
+        self.assertEqual(e.exception.errno, ENOATTR)
+
+    def test_key_class(self):
+        self.assertIn("user.registry.class", self.fs.listxattr("/Classy"))
+        self.assertEqual(self.fs.getxattr("/Classy", "user.registry.class"), b"MyClass")
+
+    def test_value(self):
+        self.assertEqual(sorted(self.fs.listxattr("/Plain/Text.RegSZ")),
+                ["user.registry.datatype", "user.registry.text"])
+        self.assertEqual(self.fs.getxattr("/Plain/Text.RegSZ", "user.registry.datatype"), b"RegSZ")
+        self.assertEqual(self.fs.getxattr("/Plain/Text.RegSZ", "user.registry.text"), b"True")
+        # / is the hive's root key here
+        self.assertEqual(self.fs.getxattr("/", "user.registry.subkeys"), b"2")
+
+
+class TestFileHandles(unittest.TestCase):
+    """Test FileHandles on its own, with made-up nodes and data."""
+
+    def setUp(self):
+        self.handles = FileHandles(budget=10)
+        self.renders = []
+
+    def render(self, node):
+        self.renders.append(node)
+        return b"x" * node.size
+
+    def test_buffer(self):
+        fh = self.handles.open(Node(Node.VALUE, size=4))
+        # Rendered once, then reused
+        self.assertEqual(self.handles.buffer(fh, self.render).tobytes(), b"xxxx")
+        self.handles.buffer(fh, self.render)
+        self.assertEqual(len(self.renders), 1)
+        self.assertEqual(self.handles.used, 4)
+        self.handles.release(fh)
+        self.assertEqual(self.handles.used, 0)
+        with self.assertRaises(KeyError):
+            self.handles.node(fh)
+
+    def test_budget(self):
+        first = self.handles.open(Node(Node.VALUE, size=6))
+        second = self.handles.open(Node(Node.VALUE, size=6))
+        self.handles.buffer(first, self.render)
+        self.handles.buffer(second, self.render)
+        # Only one fits, so the first one had to go and gets rendered again
+        self.assertEqual(self.handles.used, 6)
+        self.handles.buffer(first, self.render)
+        self.assertEqual(len(self.renders), 3)
+        # Something bigger than the whole budget is still served
+        big = self.handles.open(Node(Node.VALUE, size=20))
+        self.assertEqual(len(self.handles.buffer(big, self.render)), 20)
+        self.assertEqual(self.handles.used, 20)
+
+    def test_threads(self):
+        errors = []
+        def hammer():
+            try:
+                for i in range(500):
+                    fh = self.handles.open(Node(Node.VALUE, size=i % 7))
+                    if self.handles.buffer(fh, self.render).tobytes() != b"x" * (i % 7):
+                        errors.append(fh)
+                    self.handles.release(fh)
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=hammer) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.handles.used, 0)
+        self.assertEqual(len(self.handles), 0)
+
+
+class TestPrefetcher(unittest.TestCase):
+    """Test Prefetcher against a basic RegistryTree."""
+
+    def setUp(self):
+        self.tree = RegistryTree()
+        self.tree.load(REG_EXAMPLE_FILE)
+        self.prefetcher = Prefetcher(depth=2)
+
+    def test_walk(self):
+        self.prefetcher.start(self.tree)
+        self.prefetcher.join()
+        self.assertEqual(self.prefetcher.visited, len(list(self.tree.walk("/", 2))))
+        self.assertGreater(len(self.tree.paths), 0)
+
+    def test_pause(self):
+        # Nothing happens while an operation is in progress
+        self.prefetcher.begin()
+        self.prefetcher.start(self.tree)
+        time.sleep(0.1)
+        self.assertLessEqual(self.prefetcher.visited, 1)
+        self.prefetcher.end()
+        self.prefetcher.join()
+        self.assertGreater(self.prefetcher.visited, 1)
+        # And it can be stopped partway
+        self.prefetcher.begin()
+        self.prefetcher.start(self.tree)
+        self.prefetcher.stop()
+        self.prefetcher.end()
+
+    def test_error(self):
+        # A walk that fails says why, rather than just stopping
+        fs = WinRegFS()
+        fs.tree = RegistryTree() # never loaded
+        fs.prefetcher = self.prefetcher
+        fs.stats = OpStats()
+        self.prefetcher.start(fs.tree)
+        self.prefetcher.join()
+        self.assertIn("load()", self.prefetcher.error)
+        stats = json.loads(fs._stats_data("stats").decode("utf-8"))
+        self.assertEqual(stats["prefetch"]["error"], self.prefetcher.error)
+
+    def test_listing(self):
+        # A directory listing counts as in progress until it's read through
+        fs = WinRegFS()
+        fs.tree = self.tree
+        fs.prefetcher = self.prefetcher
+        listing = fs("readdir", "/", 0, 0)
+        next(listing)
+        self.prefetcher.start(self.tree)
+        time.sleep(0.1)
+        self.assertLessEqual(self.prefetcher.visited, 1)
+        list(listing)
+        self.prefetcher.join()
+        self.assertGreater(self.prefetcher.visited, 1)
+
+
+class TestOpStats(unittest.TestCase):
+    """Test OpStats on its own, with made-up timings."""
+
+    def setUp(self):
+        self.stats = OpStats()
+
+    def test_summary(self):
+        for i in range(99):
+            self.stats.add("getattr", 0.000003)
+        self.stats.add("getattr", 0.001, error=True)
+        self.stats.add("read", 0.00001, nbytes=4096)
+        ops = self.stats.summary()["ops"]
+        self.assertEqual(ops["getattr"]["calls"], 100)
+        self.assertEqual(ops["getattr"]["errors"], 1)
+        # 3 us falls in the 2-4 us bucket, 1 ms in the 512-1024 us one
+        self.assertEqual(ops["getattr"]["histogram_us"], {"<4": 99, "<1024": 1})
+        self.assertEqual(ops["getattr"]["p50_us"], 4)
+        self.assertEqual(ops["getattr"]["p99_us"], 4)
+        self.assertEqual(ops["read"]["bytes"], 4096)
+
+    def test_reset(self):
+        tree = RegistryTree()
+        tree.load(REG_EXAMPLE_FILE)
+        tree.key_cache.get("missing")
+        self.stats.add("getattr", 0.000003)
+        self.stats.reset(tree)
+        self.assertEqual(self.stats.summary(tree)["ops"], {})
+        # Cache counts are from the reset on
+        self.assertEqual(self.stats.summary(tree)["caches"]["key_cache"]["misses"], 0)
+        tree.key_cache.get("missing")
+        self.assertEqual(self.stats.summary(tree)["caches"]["key_cache"]["misses"], 1)
+
+
+class TestTracer(unittest.TestCase):
+    """Test Tracer on its own, with made-up operations."""
+
+    class FileInfo(object):
+        fh = 3
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tracefile = os.path.join(self.tmpdir, "trace")
+        self.tracer = Tracer(self.tracefile)
+        self.tracer.start()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def lines(self):
+        self.tracer.close()
+        with open(self.tracefile) as f:
+            return [line.rstrip("\n").split("\t") for line in f
+                    if not line.startswith("#")]
+
+    def test_record(self):
+        start = self.tracer.started
+        self.tracer.record("read", ("/a", 4096, 8192, self.FileInfo()), start, 0.000012)
+        self.tracer.record("readdir", ("/", 0, 5), start, 0.001, count=7)
+        self.tracer.record("getattr", ("/missing", None), start, 0.000002, error=2)
+        read, readdir, getattr = self.lines()
+        self.assertEqual(read[1:], ["12", "read", "/a", "4096", "8192", "3", "", "0"])
+        self.assertEqual(readdir[2:6], ["readdir", "/", "7", "5"])
+        self.assertEqual(getattr[-1], "2")
+
+    def test_start(self):
+        # A mount's trace isn't written to until init(), after any fork
+        tracefile = os.path.join(self.tmpdir, "mounted")
+        fs = WinRegFS()
+        fs.setup(REG_EXAMPLE_FILE, self.tmpdir, trace=tracefile, options={})
+        self.assertEqual(os.path.getsize(tracefile), 0)
+        fs.init("/")
+        fs("getattr", "/", None)
+        fs.destroy("/")
+        with open(tracefile) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("# winregfs trace started"))
+
+    def test_escape(self):
+        path = "/odd\tname\\with\nthings"
+        self.tracer.record("getattr", (path, None), self.tracer.started, 0)
+        line, = self.lines()
+        self.assertEqual(len(line), len(Tracer.FIELDS))
+        self.assertEqual(Tracer.unescape(line[3]), path)
+
+
 if __name__ == '__main__':
     unittest.main()
     #suite = unittest.TestSuite()